@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""
+    File: belief_store.py
+    Author: Keith Gladstone
+    Description:
+        Dense, array-backed demand beliefs for demand_learning and LEVRS
+    Notes:
+        value and beta have shape (X, Y, 2 day codes, 48 time blocks)
+        A pixel only counts once it is known (initialized with a prior beta),
+        unknown pixels hold zero demand
+        The grid grows when a pixel outside of it is initialized, up to
+        the pixel_ops grid: a pixel beyond that is a bad coordinate, not
+        a reason to allocate. Cleaned files from before MAX_LATITUDE can
+        have such pixels, so everything that learns or loads beliefs
+        leaves them out, counting them in left_out for the caller to report
+        Directional demand is answered from a summed-area table per
+        (day code, time block), rebuilt lazily after that block changes
+        The binary format is three .npy files sharing a prefix
+        (<prefix>_value.npy, <prefix>_beta.npy, <prefix>_known.npy),
+        which load_npy can memory-map. save_npy writes each file to a
+        temporary name and renames it, so processes that have the old
+        files mapped keep reading a consistent copy
+        save_npz writes all three, plus any extra arrays, as one file that
+        is renamed into place, for checkpoints that must not be torn
+"""
+import os
+
+import numpy as np
+
+import pixel_ops
+
+DAY_CODES = 2
+TIME_BLOCKS = 48
+DEMAND_DECIMALS = 9
+
+class BeliefStore(object):
+    '''Demand value and beta for every (pixel, day code, time block)'''
+    def __init__(self, x_size=0, y_size=0):
+        self.value = np.zeros((x_size, y_size, DAY_CODES, TIME_BLOCKS))
+        self.beta = np.zeros((x_size, y_size, DAY_CODES, TIME_BLOCKS))
+        self.known = np.zeros((x_size, y_size), dtype=bool)
+        self.summed_area = dict() # (day_code, time_block) -> summed-area table
+        self.left_out = 0         # observations and rows outside of the grid
+
+    @property
+    def shape(self):
+        return self.known.shape
+
+    def __contains__(self, pixel):
+        x_coord, y_coord = pixel
+        x_size, y_size = self.shape
+        return 0 <= x_coord < x_size and 0 <= y_coord < y_size and \
+               bool(self.known[x_coord, y_coord])
+
+    def __len__(self):
+        return int(self.known.sum())
+
+    def pixels(self):
+        '''List the known pixels'''
+        x_coords, y_coords = np.nonzero(self.known)
+        return zip(x_coords.tolist(), y_coords.tolist())
+
+    def grow(self, x_size, y_size):
+        '''Enlarge the grid to at least (x_size, y_size), keeping all beliefs'''
+        old_x_size, old_y_size = self.shape
+        if x_size <= old_x_size and y_size <= old_y_size:
+            return self
+        assert(x_size <= pixel_ops.GRID_X_SIZE and y_size <= pixel_ops.GRID_Y_SIZE), \
+            "Pixel (%s, %s) is outside of the grid" % (x_size - 1, y_size - 1)
+        # Grow by at least half again so a stream of new pixels does not copy every time
+        x_size = max(x_size, old_x_size, min((old_x_size * 3) / 2, pixel_ops.GRID_X_SIZE))
+        y_size = max(y_size, old_y_size, min((old_y_size * 3) / 2, pixel_ops.GRID_Y_SIZE))
+        value = np.zeros((x_size, y_size, DAY_CODES, TIME_BLOCKS))
+        beta = np.zeros((x_size, y_size, DAY_CODES, TIME_BLOCKS))
+        known = np.zeros((x_size, y_size), dtype=bool)
+        value[:old_x_size, :old_y_size] = self.value
+        beta[:old_x_size, :old_y_size] = self.beta
+        known[:old_x_size, :old_y_size] = self.known
+        self.value, self.beta, self.known = value, beta, known
+        self.summed_area.clear()
+        return self
+
+    def initialize_pixel(self, pixel, prior_beta):
+        '''Zero demand with prior_beta for every day code and time block of pixel'''
+        x_coord, y_coord = pixel
+        self.grow(x_coord + 1, y_coord + 1)
+        self.value[x_coord, y_coord] = 0
+        self.beta[x_coord, y_coord] = prior_beta
+        self.known[x_coord, y_coord] = True
+        self.summed_area.clear()
+        return self
+
+    def initialize_pixels(self, x_coords, y_coords, prior_beta):
+        '''initialize_pixel for every pixel in the arrays that is not known yet'''
+        if len(x_coords) == 0:
+            return self
+        self.grow(int(np.max(x_coords)) + 1, int(np.max(y_coords)) + 1)
+        unknown = ~self.known[x_coords, y_coords]
+        x_coords, y_coords = x_coords[unknown], y_coords[unknown]
+        self.value[x_coords, y_coords] = 0
+        self.beta[x_coords, y_coords] = prior_beta
+        self.known[x_coords, y_coords] = True
+        self.summed_area.clear()
+        return self
+
+    def observe(self, x_coords, y_coords, day_codes, time_blocks, observations, beta_obs):
+        '''Bayesian update of every cell with all of its observations at once.
+           k observations o_i move (value, beta) to
+           ((value * beta + beta_obs * sum(o_i)) / (beta + k * beta_obs), beta + k * beta_obs),
+           the same as k one-at-a-time updates. Cells must be known.'''
+        if len(x_coords) == 0:
+            return self
+        cells = np.ravel_multi_index((x_coords, y_coords, day_codes, time_blocks),
+                                     self.value.shape)
+        cells, cell_of_observation = np.unique(cells, return_inverse=True)
+        counts = np.bincount(cell_of_observation)
+        sums = np.bincount(cell_of_observation, weights=observations)
+        index = np.unravel_index(cells, self.value.shape)
+        prior_value, prior_beta = self.value[index], self.beta[index]
+        posterior_beta = prior_beta + counts * beta_obs
+        self.value[index] = (prior_value * prior_beta + beta_obs * sums) / posterior_beta
+        self.beta[index] = posterior_beta
+        for key in set(zip(index[2].tolist(), index[3].tolist())):
+            self.summed_area.pop(key, None)
+        return self
+
+    def get(self, pixel, day_code, time_block):
+        '''Get (demand_value, beta) of a cell'''
+        x_coord, y_coord = pixel
+        return (self.value[x_coord, y_coord, day_code, time_block],
+                self.beta[x_coord, y_coord, day_code, time_block])
+
+    def set(self, pixel, day_code, time_block, demand_value, beta):
+        '''Set (demand_value, beta) of a cell'''
+        x_coord, y_coord = pixel
+        self.value[x_coord, y_coord, day_code, time_block] = demand_value
+        self.beta[x_coord, y_coord, day_code, time_block] = beta
+        self.summed_area.pop((day_code, time_block), None)
+        return self
+
+    def demand_grid(self, day_code, time_block):
+        '''2D (X, Y) view of demand values for one day code and time block'''
+        return self.value[:, :, day_code, time_block]
+
+    def summed_area_table(self, day_code, time_block):
+        '''Table S with S[i, j] = sum of demand_grid[:i, :j], built on first use'''
+        key = (day_code, time_block)
+        if key not in self.summed_area:
+            x_size, y_size = self.shape
+            table = np.zeros((x_size + 1, y_size + 1))
+            table[1:, 1:] = self.demand_grid(day_code, time_block).cumsum(0).cumsum(1)
+            self.summed_area[key] = table
+        return self.summed_area[key]
+
+    def directional_demand(self, pixel, day_code, time_block, degree):
+        '''Demand right, up, left and down of pixel within its superpixel of degree.
+           Like pixel_ops.get_superpixel_degree_n, coordinates must be positive.'''
+        current_x, current_y = pixel
+        directional_demand = self.directional_demand_batch([current_x], [current_y],
+                                                           day_code, time_block, degree)
+        return directional_demand[0].tolist()
+
+    def directional_demand_batch(self, x_coords, y_coords, day_code, time_block, degree):
+        '''directional_demand for many pixels at once, as an (N, 4) array whose
+           columns are right, up, left and down'''
+        x_coords = np.asarray(x_coords, dtype=int)
+        y_coords = np.asarray(y_coords, dtype=int)
+        x_size, y_size = self.shape
+        table = self.summed_area_table(day_code, time_block)
+        x_lo = np.maximum(x_coords - degree, 1)
+        x_hi = np.minimum(x_coords + degree + 1, x_size)
+        y_lo = np.maximum(y_coords - degree, 1)
+        y_hi = np.minimum(y_coords + degree + 1, y_size)
+
+        def rectangle_sums(x_start, x_end, y_start, y_end):
+            '''Sums of demand_grid[x_start:x_end, y_start:y_end], zero when empty'''
+            x_end = np.clip(x_end, 0, x_size)
+            y_end = np.clip(y_end, 0, y_size)
+            x_start = np.minimum(x_start, x_end)
+            y_start = np.minimum(y_start, y_end)
+            return table[x_end, y_end] - table[x_start, y_end] - \
+                   table[x_end, y_start] + table[x_start, y_start]
+
+        directional_demand = np.column_stack([
+            rectangle_sums(np.maximum(x_coords + 1, x_lo), x_hi, y_lo, y_hi),
+            rectangle_sums(x_lo, x_hi, np.maximum(y_coords + 1, y_lo), y_hi),
+            rectangle_sums(x_lo, np.minimum(x_coords, x_hi), y_lo, y_hi),
+            rectangle_sums(x_lo, x_hi, y_lo, np.minimum(y_coords, y_hi))])
+        # Prefix differences of equal sums can be a few ulps apart, round them so
+        # they still tie
+        return np.round(directional_demand, DEMAND_DECIMALS)
+
+    def load_csv(self, filename):
+        '''Load rows of "(x, y),day_code,time_block,(demand_value, beta)",
+           rows outside of the grid are left out'''
+        with open(filename, "rb") as input_file:
+            text = input_file.read()
+        text = text.translate(None, "() ").replace("\n", ",")
+        rows = np.fromstring(text, dtype=np.float64, sep=",").reshape(-1, 6)
+        inside = pixel_ops.in_grid(rows[:, 0], rows[:, 1])
+        self.left_out += len(rows) - int(np.count_nonzero(inside))
+        rows = rows[inside]
+        x_coords, y_coords, day_codes, time_blocks = rows[:, :4].astype(int).T
+        if len(rows) > 0:
+            self.grow(x_coords.max() + 1, y_coords.max() + 1)
+        self.value[x_coords, y_coords, day_codes, time_blocks] = rows[:, 4]
+        self.beta[x_coords, y_coords, day_codes, time_blocks] = rows[:, 5]
+        self.known[x_coords, y_coords] = True
+        self.summed_area.clear()
+        return self
+
+    def load_npy(self, prefix, mmap_mode=None):
+        '''Load the binary format, memory-mapped unless mmap_mode is None.
+           mmap_mode "r" shares the page-cached file read-only,
+           "c" is copy-on-write so updates stay private to this process'''
+        self.value = np.load(prefix + "_value.npy", mmap_mode=mmap_mode)
+        self.beta = np.load(prefix + "_beta.npy", mmap_mode=mmap_mode)
+        self.known = np.load(prefix + "_known.npy")
+        self.summed_area.clear()
+        assert(self.value.shape == self.beta.shape and \
+               self.value.shape[:2] == self.known.shape), "Prior files do not match"
+        return self
+
+    def save_npy(self, prefix):
+        '''Write the binary format'''
+        for suffix, array in (("_value.npy", self.value),
+                              ("_beta.npy", self.beta),
+                              ("_known.npy", self.known)):
+            with open(prefix + suffix + ".tmp", "wb") as output_file:
+                np.save(output_file, np.ascontiguousarray(array))
+            os.rename(prefix + suffix + ".tmp", prefix + suffix)
+        return
+
+    def load_npz(self, filename):
+        '''Load the arrays written by save_npz, extra arrays are left in the file'''
+        with np.load(filename) as arrays:
+            self.value = arrays["value"]
+            self.beta = arrays["beta"]
+            self.known = arrays["known"]
+        self.summed_area.clear()
+        return self
+
+    def save_npz(self, filename, **extra):
+        '''Write value, beta, known and the extra arrays to one file, all or nothing'''
+        with open(filename + ".tmp", "wb") as output_file:
+            np.savez(output_file, value=self.value, beta=self.beta, known=self.known, **extra)
+        os.rename(filename + ".tmp", filename)
+        return
+
+    def save_csv(self, filename, rows_per_chunk=100000):
+        '''Write every cell of every known pixel in the load_csv format'''
+        x_coords, y_coords = np.nonzero(self.known)
+        cells = len(x_coords) * DAY_CODES * TIME_BLOCKS
+        rows = np.empty((cells, 6))
+        rows[:, 0] = np.repeat(x_coords, DAY_CODES * TIME_BLOCKS)
+        rows[:, 1] = np.repeat(y_coords, DAY_CODES * TIME_BLOCKS)
+        rows[:, 2] = np.tile(np.repeat(np.arange(DAY_CODES), TIME_BLOCKS), len(x_coords))
+        rows[:, 3] = np.tile(np.arange(TIME_BLOCKS), DAY_CODES * len(x_coords))
+        rows[:, 4] = self.value[x_coords, y_coords].ravel()
+        rows[:, 5] = self.beta[x_coords, y_coords].ravel()
+        row_format = "(%d, %d),%d,%d,(%r, %r)\n"
+        with open(filename, "w") as output_file:
+            for start in xrange(0, cells, rows_per_chunk):
+                chunk = rows[start:start + rows_per_chunk]
+                output_file.write((row_format * len(chunk)) % tuple(chunk.ravel().tolist()))
+        return
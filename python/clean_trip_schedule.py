@@ -6,29 +6,61 @@
     Description:
     This file cleans raw NYC yellowcab data files,
     removing some columns and transforming others
+    Notes:
+    The raw file is split into byte ranges on line boundaries and the
+    ranges are cleaned in a process pool, each into its own part file.
+    Within a range, blocks of rows are cleaned at once by clean_block,
+    the array version of clean_trip.
+    The parts are then merged in order, which is where the pickup time
+    ordering is checked across parts and trip ids are assigned.
+    Raw rows must not contain quoted newlines.
 """
 
+import os
 import sys
 import csv
 from datetime import datetime
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+import numpy as np
 import pixel_ops
 import generic_ops
 
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+ROWS_PER_BLOCK = 100000
+
+# NYC cutoff
+MIN_LONGITUDE = -74.163208
+MAX_LONGITUDE = -73.829498
+MIN_LATITUDE = 40.57
+MAX_LATITUDE = 40.92
+
+# date string -> (seconds from beginning of year to that midnight, day of week)
+DATE_CACHE = dict()
+
+def parse_date(date_str):
+    '''Get (seconds since beginning of year, day of week) of a midnight, cached by date'''
+    if date_str not in DATE_CACHE:
+        midnight = datetime.strptime(date_str + ' 00:00:00', TIMESTAMP_FORMAT)
+        beginning_of_year = datetime.strptime(generic_ops.get_beginning_of_year(),
+                                              TIMESTAMP_FORMAT)
+        # Sunday = 0, Monday = 1, Tuesday = 2, etc.
+        days_passed = (midnight - datetime(2000, 1, 1)).days - 1
+        DATE_CACHE[date_str] = ((midnight - beginning_of_year).total_seconds(),
+                                days_passed % 7)
+    return DATE_CACHE[date_str]
+
 def seconds_since_midnight(t_str):
-    beginning_of_year = generic_ops.get_beginning_of_year()
-    date_b = datetime.strptime(t_str, '%Y-%m-%d %H:%M:%S')
-    date_a = datetime.strptime(beginning_of_year, '%Y-%m-%d %H:%M:%S')
-    time = (date_b - date_a).total_seconds()
-    return time
+    '''Seconds since the beginning of the year, as a float'''
+    date_str, clock_str = t_str.split(' ')
+    hours, minutes, seconds = clock_str.split(':')
+    return parse_date(date_str)[0] + (int(hours) * 3600 + int(minutes) * 60 + int(seconds))
 
 def day_of_week(t_str):
     # Sunday = 0
     # Monday = 1
     # Tuesday = 2, etc.
-    date_b = datetime.strptime(t_str, '%Y-%m-%d %H:%M:%S')
-    date_a = datetime.strptime('2000-01-01 00:00:00', '%Y-%m-%d %H:%M:%S')
-    days_passed = (date_b - date_a).days - 1
-    return days_passed % 7
+    return parse_date(t_str.split(' ')[0])[1]
 
 def is_raw_trip_valid(raw_trip):
     # Pure sanity
@@ -42,14 +74,17 @@ def is_raw_trip_valid(raw_trip):
           int(float(raw_trip['dropoff_latitude'])) == 0):
         return False
     # NYC cutoff
-    elif (float(raw_trip['dropoff_longitude']) < -74.163208 or
-          float(raw_trip['pickup_longitude']) < -74.163208 or
+    elif (float(raw_trip['dropoff_longitude']) < MIN_LONGITUDE or
+          float(raw_trip['pickup_longitude']) < MIN_LONGITUDE or
 
-          float(raw_trip['dropoff_latitude']) < 40.57 or
-          float(raw_trip['pickup_latitude']) < 40.57 or
+          float(raw_trip['dropoff_latitude']) < MIN_LATITUDE or
+          float(raw_trip['pickup_latitude']) < MIN_LATITUDE or
 
-          float(raw_trip['dropoff_longitude']) > -73.829498 or
-          float(raw_trip['pickup_longitude']) > -73.829498
+          float(raw_trip['dropoff_longitude']) > MAX_LONGITUDE or
+          float(raw_trip['pickup_longitude']) > MAX_LONGITUDE or
+
+          float(raw_trip['dropoff_latitude']) > MAX_LATITUDE or
+          float(raw_trip['pickup_latitude']) > MAX_LATITUDE
          ):
         return False
     else:
@@ -92,6 +127,66 @@ def clean_trip(raw_trip):
 
     return trip_dict
 
+def parse_timestamps(timestamps):
+    '''Vectorized seconds_since_midnight (as floats) and day_of_week'''
+    times = timestamps.astype('datetime64[s]')
+    beginning_of_year = np.datetime64(generic_ops.get_beginning_of_year())
+    seconds = (times - beginning_of_year).astype(np.int64).astype(float)
+    # Floor division, like timedelta.days
+    days_passed = (times - np.datetime64('2000-01-01 00:00:00')).astype(np.int64) // 86400 - 1
+    return seconds, days_passed % 7
+
+def clean_block(header, raw_rows):
+    '''Vectorized clean_trip over raw csv rows (lists of strings, header order).
+       Returns the cleaned rows, trip_keys without trip_id and vehicle_id, and their
+       pickup request times. Gives exactly what clean_trip gives row by row.'''
+    def column(name, rows):
+        index = header.index(name)
+        return [raw_rows[row][index] for row in rows]
+
+    every_row = xrange(len(raw_rows))
+    pickup_datetime = np.array(column('tpep_pickup_datetime', every_row))
+    dropoff_datetime = np.array(column('tpep_dropoff_datetime', every_row))
+    pickup_longitude, pickup_latitude, dropoff_longitude, dropoff_latitude = \
+        [np.array(column(name, every_row), dtype=float)
+         for name in ('pickup_longitude', 'pickup_latitude',
+                      'dropoff_longitude', 'dropoff_latitude')]
+
+    # is_raw_trip_valid (its passenger_count <= 0 test compares a string, so never
+    # fires, zero occupancy is caught at the end)
+    valid = pickup_datetime != dropoff_datetime
+    for coordinate in (pickup_longitude, pickup_latitude, dropoff_longitude, dropoff_latitude):
+        valid &= np.trunc(coordinate) != 0
+    valid &= (dropoff_longitude >= MIN_LONGITUDE) & (pickup_longitude >= MIN_LONGITUDE) & \
+             (dropoff_latitude >= MIN_LATITUDE) & (pickup_latitude >= MIN_LATITUDE) & \
+             (dropoff_longitude <= MAX_LONGITUDE) & (pickup_longitude <= MAX_LONGITUDE) & \
+             (dropoff_latitude <= MAX_LATITUDE) & (pickup_latitude <= MAX_LATITUDE)
+    rows = np.flatnonzero(valid)
+
+    pickup_x, pickup_y = pixel_ops.pixelate_arrays(pickup_longitude[rows], pickup_latitude[rows])
+    dropoff_x, dropoff_y = pixel_ops.pixelate_arrays(dropoff_longitude[rows],
+                                                     dropoff_latitude[rows])
+    pickup_request_time, day = parse_timestamps(pickup_datetime[rows])
+    original_dropoff_time, _ = parse_timestamps(dropoff_datetime[rows])
+
+    # Time order and zero distance
+    keep = (pickup_request_time <= original_dropoff_time) & \
+           (np.abs(pickup_x - dropoff_x) + np.abs(pickup_y - dropoff_y) != 0)
+    rows = rows[keep]
+
+    # Zero occupancy, int() only on the rows clean_trip would get this far with
+    occupancy = column('passenger_count', rows)
+    keep[keep] = np.array([int(passengers) != 0 for passengers in occupancy], dtype=bool)
+    occupancy = [passengers for passengers in occupancy if int(passengers) != 0]
+
+    cleaned_rows = zip(occupancy,
+                       pickup_x[keep].tolist(), pickup_y[keep].tolist(),
+                       dropoff_x[keep].tolist(), dropoff_y[keep].tolist(),
+                       pickup_request_time[keep].tolist(),
+                       original_dropoff_time[keep].tolist(),
+                       day[keep].tolist())
+    return cleaned_rows, pickup_request_time[keep]
+
 def serial_read_clean(input_file, output_file_writer):
     counter = 0
     reader = csv.DictReader(input_file)
@@ -109,14 +204,119 @@ def serial_read_clean(input_file, output_file_writer):
             output_file_writer.writerow(cleaned_trip)
     return
 
-def run_clean_trip_schedule(rawdata_filename):
+def clean_byte_range(job):
+    '''Clean the raw rows starting in [start, end) into a part file of cleaned rows
+       without their trip_id and vehicle_id columns.
+       Returns (number of trips, first and last pickup request time)'''
+    raw_filepath, header, start, end, part_filepath = job
+    count, first_departure_time, prev_departure_time = 0, None, None
+    with open(raw_filepath, 'rb') as input_file, open(part_filepath, 'wb') as part_file:
+        input_file.seek(start)
+        reader = csv.reader(lines_in_range(input_file, end - start))
+        writer = csv.writer(part_file)
+        while True:
+            block = list(islice(reader, ROWS_PER_BLOCK))
+            if len(block) == 0:
+                break
+            # csv.DictReader skips blank lines
+            cleaned_rows, departure_times = clean_block(header, [row for row in block if row])
+            if len(cleaned_rows) == 0:
+                continue
+            if (np.diff(departure_times) < 0).any() or \
+               (prev_departure_time is not None and departure_times[0] < prev_departure_time):
+                assert(False), "This trip stream is invalid. Trips are unordered."
+            if first_departure_time is None:
+                first_departure_time = float(departure_times[0])
+            prev_departure_time = float(departure_times[-1])
+            writer.writerows(cleaned_rows)
+            count += len(cleaned_rows)
+    return count, first_departure_time, prev_departure_time
+
+def lines_in_range(input_file, length):
+    '''Lines of input_file from its position until length bytes are used up'''
+    while length > 0:
+        line = input_file.readline()
+        if not line:
+            return
+        length -= len(line)
+        yield line
+
+def byte_ranges(input_file, start, number_of_ranges):
+    '''Split input_file from start to the end into ranges that begin on a line'''
+    input_file.seek(0, os.SEEK_END)
+    size = input_file.tell()
+    boundaries = [start]
+    for k in range(1, number_of_ranges):
+        input_file.seek(max(start + (size - start) * k / number_of_ranges - 1, start))
+        input_file.readline()
+        boundaries.append(max(input_file.tell(), boundaries[-1]))
+    boundaries.append(size)
+    return [(boundaries[k], boundaries[k + 1]) for k in range(number_of_ranges)
+            if boundaries[k] < boundaries[k + 1]]
+
+def merge_cleaned_parts(part_results, output_file):
+    '''Append parts in order, checking order across them and numbering the trips'''
+    counter = 0
+    prev_departure_time = -1*(sys.maxint)-1
+    for part_filepath, (count, first_departure_time, last_departure_time) in part_results:
+        if count > 0:
+            if first_departure_time < prev_departure_time:
+                assert(False), "This trip stream is invalid. Trips are unordered."
+            prev_departure_time = last_departure_time
+        with open(part_filepath, 'rb') as part_file:
+            for line in part_file:
+                # csv rows end in \r\n, trip_id and vehicle_id are the last columns
+                output_file.write("%s,%d,%d\r\n" % (line[:-2], counter, counter))
+                counter += 1
+        os.remove(part_filepath)
+    return counter
+
+def run_clean_trip_schedule(rawdata_filename, processes=None):
+    '''Clean a raw data file in parallel, processes defaults to the number of cores'''
     raw_filepath = '../csv/raw/' + rawdata_filename + '.csv'
     cleaned_filepath = generic_ops.cleaned_fp(rawdata_filename)
-    input_file = open(raw_filepath, 'rb')
-    open(cleaned_filepath, 'w').close() # reset output_file
-    output_file = open(cleaned_filepath, 'wa')
-    output_file_writer = csv.DictWriter(output_file, trip_keys())
-    output_file_writer.writeheader()
-
-    # Clean all data
-    serial_read_clean(input_file, output_file_writer)
+    if processes is None:
+        processes = cpu_count()
+
+    with open(raw_filepath, 'rb') as input_file:
+        header_line = input_file.readline()
+        header = csv.reader([header_line]).next()
+        # A few ranges per process evens out uneven chunks
+        ranges = byte_ranges(input_file, len(header_line), 4 * processes)
+    jobs = [(raw_filepath, header, start, end, cleaned_filepath + ".part%d" % k)
+            for k, (start, end) in enumerate(ranges)]
+
+    try:
+        if processes == 1:
+            results = map(clean_byte_range, jobs)
+        else:
+            pool = Pool(processes)
+            results = pool.map(clean_byte_range, jobs)
+            pool.close()
+            pool.join()
+
+        with open(cleaned_filepath, 'wb') as output_file:
+            output_file_writer = csv.DictWriter(output_file, trip_keys())
+            output_file_writer.writeheader()
+
+            # Clean all data
+            merge_cleaned_parts(zip([job[-1] for job in jobs], results), output_file)
+    finally:
+        for job in jobs:
+            if os.path.isfile(job[-1]):
+                os.remove(job[-1])
+
+def test_clean_block(rawdata_filename, rows=100000):
+    '''Test that "clean_block" matches "clean_trip" on the first rows of a raw file'''
+    with open('../csv/raw/' + rawdata_filename + '.csv', 'rb') as input_file:
+        reader = csv.reader(input_file)
+        header = reader.next()
+        raw_rows = [row for row in islice(reader, rows) if row]
+    expected = list()
+    for raw_row in raw_rows:
+        cleaned_trip = clean_trip(dict(zip(header, raw_row)))
+        if cleaned_trip is not None:
+            expected.append(tuple(cleaned_trip[key] for key in trip_keys()[:-2]))
+    cleaned_rows, _ = clean_block(header, raw_rows)
+    assert(cleaned_rows == expected), "clean_block does not match clean_trip"
+    print "clean_block matches clean_trip on %s rows" % (len(raw_rows))
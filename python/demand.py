@@ -6,117 +6,200 @@
         This file contains functions that are used
         by run_demand.py and demand_plot.py to
         plot occupancy and request rate graphs
+    Notes:
+        Demand series are of root_file's cleaned trips, read from the file
+        only when a series is not cached
+        Request demand is answered from a DemandIndex, a per pickup pixel,
+        per minute histogram with 2D prefix sums over the pixels, built
+        once per root_file
+        Demand series are cached as .npy files named by a hash of the source
+        trip file (path, size and mtime) and the query, so a changed source
+        misses the cache. The least recently used files are removed once
+        the cache grows past DEMAND_CACHE_BYTES
+        Citywide occupancy is an occupancy_timeline, a difference array of
+        +occupancy at pickup and -occupancy at dropoff, summed up
 """
-from pathlib import Path
-import csv
+import hashlib
+import os
+import numpy as np
 import trip_ops
 import pixel_ops
-import generic_ops
 
-def make_trip_request_schedule(trip_log, args):
-    '''Create time schedule of trips requested in a given minute.'''
-    start_second = 32572800
-    print "Creating trip origin log indexed by minute."
-    pixel_list = args['pixel_list']
-    time_schedule = dict()
-    for trip_id in trip_log:
-        trip = trip_ops.get_trip(trip_log, trip_id)
-        for pixel in pixel_list:
-            if pixel_ops.same_pixel(trip.pickup_pixel, pixel):
-                minute = int((trip.pickup_request_time - start_second)/ 60)
-                assert minute >= 0 and minute <= 1440
-                time_schedule = generic_ops.add_to_dict_of_lists(time_schedule,
-                                                                 minute,
-                                                                 trip.trip_id)
-    return time_schedule
+REQUEST_SCHEDULE_START = 32572800
+MINUTES_IN_SCHEDULE = 1441
+SECONDS_IN_DAY = 86400
+DEMAND_CACHE_DIR = "../csv/demand_progress/"
+DEMAND_CACHE_BYTES = 256 * 1024 * 1024
 
-def sub_make_trips_in_progress_log(trip_log):
-    '''Create time schedule of trips in progress in a given minute.'''
-    print "Creating trip progress log indexed by minute."
-    start_second = 33609600 # for the week data
+# root_file -> DemandIndex
+DEMAND_INDEXES = dict()
 
-    time_schedule = dict()
-    for trip_id in trip_log:
-        if trip_id % 1000 == 0:
-            print trip_id
-        trip = trip_ops.get_trip(trip_log, trip_id)
-        pickup_minute = (trip.pickup_request_time - start_second) / 60
-        dropoff_minute = (trip.original_dropoff_time - start_second) / 60
+class DemandIndex(object):
+    '''Occupants requesting per (pickup pixel, minute since start_second).
+       prefix[i, j, minute] is the demand of pixels [x0, x0 + i) x [y0, y0 + j),
+       so any rectangle of pixels costs four lookups per minute.
+       Requests outside of the schedule or the pixel_ops grid are left out,
+       dropped counts them.'''
+    def __init__(self, pickup_x, pickup_y, request_time, occupancy,
+                 start_second=REQUEST_SCHEDULE_START, minutes=MINUTES_IN_SCHEDULE):
+        self.start_second = start_second
+        self.minutes = minutes
+        minute = (request_time - start_second) // 60
+        inside = (minute >= 0) & (minute < minutes) & pixel_ops.in_grid(pickup_x, pickup_y)
+        self.dropped = len(minute) - int(np.count_nonzero(inside))
+        pickup_x, pickup_y = pickup_x[inside], pickup_y[inside]
+        minute, occupancy = minute[inside], occupancy[inside]
+        if len(minute) == 0:
+            self.x0, self.y0 = 0, 0
+            self.prefix = np.zeros((1, 1, minutes), dtype=np.int64)
+            return
+        self.x0, self.y0 = int(pickup_x.min()), int(pickup_y.min())
+        shape = (int(pickup_x.max()) - self.x0 + 1, int(pickup_y.max()) - self.y0 + 1, minutes)
+        cells = np.ravel_multi_index((pickup_x - self.x0, pickup_y - self.y0, minute), shape)
+        histogram = np.bincount(cells, weights=occupancy,
+                                minlength=shape[0] * shape[1] * minutes)
+        histogram = histogram.astype(np.int64).reshape(shape)
+        self.prefix = np.zeros((shape[0] + 1, shape[1] + 1, minutes), dtype=np.int64)
+        self.prefix[1:, 1:] = histogram.cumsum(0).cumsum(1)
 
-        if pickup_minute >= 0:
-            assert pickup_minute <= dropoff_minute
-            minutes_range = range(pickup_minute, dropoff_minute)
-            for minute in minutes_range:
-                time_schedule = generic_ops.add_to_dict_of_lists(time_schedule,
-                                                                 minute,
-                                                                 trip.trip_id)
-    return time_schedule
+    def rectangle(self, x_lo, x_hi, y_lo, y_hi):
+        '''Demand per minute of pickup pixels x_lo..x_hi by y_lo..y_hi, inclusive'''
+        x_size, y_size = self.prefix.shape[0] - 1, self.prefix.shape[1] - 1
+        x_start = min(max(x_lo - self.x0, 0), x_size)
+        x_end = min(max(x_hi - self.x0 + 1, x_start), x_size)
+        y_start = min(max(y_lo - self.y0, 0), y_size)
+        y_end = min(max(y_hi - self.y0 + 1, y_start), y_size)
+        prefix = self.prefix
+        return prefix[x_end, y_end] - prefix[x_start, y_end] - \
+               prefix[x_end, y_start] + prefix[x_start, y_start]
 
-def make_trips_in_progress_log(trip_log, args):
-    '''Wrapper for sub_make_trips_in_progress_log.'''
-    return sub_make_trips_in_progress_log(trip_log)
+    def superpixel(self, pixel, degree):
+        '''Demand per minute of pixel_ops.get_superpixel_degree_n(pixel, degree)'''
+        x_coord, y_coord = pixel
+        return self.rectangle(max(x_coord - degree, 1), x_coord + degree,
+                              max(y_coord - degree, 1), y_coord + degree)
 
-def memoized_time_schedule(trip_log, filename, make_function, args):
-    ''' Check if generic time schedule is in cache,
-        otherwise make a new one with make_function.'''
-    my_file = Path(filename)
-    if my_file.is_file():
-        with open(filename, "rb") as inputfile:
-            reader = csv.reader(inputfile)
-            time_schedule = dict()
-            minute = 0
-            for row in reader:
-                time_schedule[minute] = row
-                minute += 1
-    else:
-        time_schedule = make_function(trip_log, args)
-        with open(filename, "wb") as outfile:
-            keys = sorted(time_schedule.keys())
-            writer = csv.writer(outfile)
-            for minute in keys:
-                writer.writerow(time_schedule[minute])
-    return time_schedule
+def build_demand_index(trip_log, start_second=REQUEST_SCHEDULE_START,
+                       minutes=MINUTES_IN_SCHEDULE):
+    '''Index the pickup demand of a trip log in one pass'''
+    trips = trip_log.values()
+    return DemandIndex(np.array([trip.pickup_pixel[0] for trip in trips], dtype=int),
+                       np.array([trip.pickup_pixel[1] for trip in trips], dtype=int),
+                       np.array([trip.pickup_request_time for trip in trips], dtype=int),
+                       np.array([trip.occupancy for trip in trips], dtype=int),
+                       start_second, minutes)
 
-def get_trip_request_schedule(trip_log, root_file, pixel, degree):
-    '''Time schedule for trip requests.'''
-    superpixel = pixel_ops.get_superpixel_degree_n(pixel, degree)
-    pixel_str = str(pixel).replace("(", "_").replace(")", "_").replace(" ", "").replace(",", "-")
-    filename = "../csv/demand_progress/" + root_file + pixel_str + "_degree" + str(degree) + ".csv"
-    args = dict()
-    args['pixel_list'] = superpixel
-    return memoized_time_schedule(trip_log, \
-        filename, make_trip_request_schedule, args)
+def get_demand_index(root_file):
+    '''DemandIndex of root_file's trip log, built on first use'''
+    if root_file not in DEMAND_INDEXES:
+        print "Creating demand index for " + root_file
+        DEMAND_INDEXES[root_file] = build_demand_index(trip_ops.get_trip_log(root_file))
+        dropped = DEMAND_INDEXES[root_file].dropped
+        if dropped > 0:
+            print "Left out %s requests outside of the schedule or the grid" % dropped
+    return DEMAND_INDEXES[root_file]
 
-def get_trips_in_progress_schedule(trip_log, root_file):
-    '''Time schedule for trips in progress.'''
-    filename = "../csv/demand_progress/" + root_file + ".csv"
-    return memoized_time_schedule(trip_log, \
-        filename, make_trips_in_progress_log, args=dict())
+def first_midnight(times):
+    '''Start of the day of the earliest time'''
+    return (int(np.min(times)) // SECONDS_IN_DAY) * SECONDS_IN_DAY
 
-def time_schedule_to_demand_count(trip_log, time_schedule, max_minute_of_schedule):
-    '''Given a time schedule of trip_IDs, sum the demand by minute.'''
-    if max_minute_of_schedule is None:
-        max_minute_of_schedule = max([m for m in time_schedule.keys()])
-    demand_list = [0 for minute in xrange(max_minute_of_schedule)]
-    for minute in xrange(max_minute_of_schedule):
-        assert minute <= max_minute_of_schedule
-        if minute in time_schedule.keys():
-            for trip_id in time_schedule[minute]:
-                trip = trip_ops.get_trip(trip_log, trip_id)
-                demand_list[minute] += trip.occupancy
-    return demand_list, max_minute_of_schedule
+def occupancy_timeline(start_times, end_times, occupancy, start_second=None,
+                       resolution=60, bins=None):
+    '''Occupants in progress per bin of resolution seconds from start_second.
+       A trip counts in the bins from its start bin up to, not including, its
+       end bin; trips starting before start_second are left out.
+       start_second defaults to the first midnight, bins to the last end bin.'''
+    start_times = np.asarray(start_times, dtype=np.int64)
+    end_times = np.asarray(end_times, dtype=np.int64)
+    occupancy = np.asarray(occupancy, dtype=np.int64)
+    if start_second is None:
+        start_second = first_midnight(start_times) if len(start_times) > 0 else 0
+    start_bins = (start_times - start_second) // resolution
+    end_bins = (end_times - start_second) // resolution
+    counted = start_bins >= 0
+    start_bins, end_bins, occupancy = start_bins[counted], end_bins[counted], occupancy[counted]
+    if bins is None:
+        bins = int(end_bins.max()) if len(end_bins) > 0 else 0
+    # Changes past the last bin never show up, park them in one extra bin
+    changes = np.bincount(np.minimum(start_bins, bins), weights=occupancy, minlength=bins + 1) - \
+              np.bincount(np.minimum(end_bins, bins), weights=occupancy, minlength=bins + 1)
+    return changes[:bins].cumsum().astype(np.int64)
+
+def demand_cache_key(root_file, query):
+    '''Hash of the trip log's source file (path, size and mtime) and the query'''
+    source_fp = os.path.abspath(trip_ops.trip_log_fp(root_file))
+    source_stat = os.stat(source_fp)
+    source = (source_fp, source_stat.st_size, source_stat.st_mtime)
+    return hashlib.sha1(repr((source, query))).hexdigest()
+
+def prune_demand_cache(cache_dir=DEMAND_CACHE_DIR, max_bytes=DEMAND_CACHE_BYTES):
+    '''Remove the least recently used series until the cache fits in max_bytes.
+       The most recent series always stays.'''
+    entries = list()
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(".npy"):
+            entry_stat = os.stat(os.path.join(cache_dir, filename))
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, filename))
+    entries.sort()
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, filename in entries[:-1]:
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, filename))
+        except OSError:
+            pass
+        total_bytes -= size
+    return
 
-def citywide_demand_per_minute(trip_log, root_file, max_minute_of_schedule):
-    '''Create a daily model of city at large.'''
-    time_schedule = get_trips_in_progress_schedule(trip_log, root_file)
-    return time_schedule_to_demand_count(trip_log, time_schedule, max_minute_of_schedule)
+def memoized_demand_series(root_file, query, make_series, cache_dir=DEMAND_CACHE_DIR):
+    '''Demand series of query on root_file's trips, from the cache when the
+       source file has not changed since, otherwise made by make_series().
+       query must be a tuple of plain values that identifies the series,
+       including its region and resolution.'''
+    key = demand_cache_key(root_file, query)
+    series_fp = os.path.join(cache_dir, key + ".npy")
+    if os.path.isfile(series_fp):
+        os.utime(series_fp, None) # mark as recently used
+        return np.load(series_fp)
+    series = make_series()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    with open(series_fp + ".tmp", "wb") as output_file:
+        np.save(output_file, series)
+    os.rename(series_fp + ".tmp", series_fp)
+    prune_demand_cache(cache_dir)
+    return series
 
-def superpixel_demand_per_minute(trip_log, root_file, pixel, degree, max_minute_of_schedule):
+def citywide_demand_per_minute(root_file, max_minute_of_schedule,
+                               start_second=None, resolution=60):
+    '''Create a model of occupants in progress in the city at large, per minute
+       (or per bin of resolution seconds) since start_second.'''
+    def make_series():
+        trips = trip_ops.get_trip_log(root_file).values()
+        return occupancy_timeline([trip.pickup_request_time for trip in trips],
+                                  [trip.original_dropoff_time for trip in trips],
+                                  [trip.occupancy for trip in trips],
+                                  start_second, resolution, max_minute_of_schedule)
+    query = ('occupancy', 'citywide', start_second, resolution, max_minute_of_schedule)
+    timeline = memoized_demand_series(root_file, query, make_series)
+    if max_minute_of_schedule is None:
+        max_minute_of_schedule = int(np.flatnonzero(timeline).max())
+    return timeline[:max_minute_of_schedule].tolist(), max_minute_of_schedule
+
+def superpixel_demand_per_minute(root_file, pixel, degree, max_minute_of_schedule):
     '''Create a daily model of occupants requesting per minute in a superpixel.'''
-    time_schedule = get_trip_request_schedule(trip_log, root_file, pixel, degree)
-    print time_schedule
-    return time_schedule_to_demand_count(trip_log, time_schedule, max_minute_of_schedule)
+    def make_series():
+        return get_demand_index(root_file).superpixel(pixel, degree)
+    query = ('requests', 'superpixel', tuple(pixel), degree,
+             REQUEST_SCHEDULE_START, 60, MINUTES_IN_SCHEDULE)
+    demand = memoized_demand_series(root_file, query, make_series)
+    if max_minute_of_schedule is None:
+        max_minute_of_schedule = int(np.flatnonzero(demand).max())
+    demand_list = demand[:max_minute_of_schedule].tolist()
+    demand_list += [0] * (max_minute_of_schedule - len(demand_list))
+    return demand_list, max_minute_of_schedule
 
-def pixel_demand_per_minute(trip_log, root_file, pixel, max_minute_of_schedule):
+def pixel_demand_per_minute(root_file, pixel, max_minute_of_schedule):
     '''Create a daily model of occupants requesting per minute in a pixel.'''
-    return superpixel_demand_per_minute(trip_log, root_file, pixel, 0, max_minute_of_schedule)
+    return superpixel_demand_per_minute(root_file, pixel, 0, max_minute_of_schedule)
@@ -10,73 +10,70 @@
         Prior beta is 1
         Num time blocks per day is 48
         Num day codes is 2
+        Beliefs are kept in a BeliefStore (see belief_store.py)
+        Offline learning streams the trip store in chunks and checkpoints
+        the priors along with how many rows of each source they include,
+        so later runs only fold in rows they have not seen
+        The checkpoint is a single file renamed into place, so the priors
+        and the row counts in it always agree. The binary prior files are
+        exported from it after every checkpoint
 """
+from pathlib import Path
+
+import numpy as np
+
 import generic_ops
-import trip_ops
+import pixel_ops
+from belief_store import BeliefStore
+from trip_store import TripStore
+
+TRIPS_PER_CHUNK = 1000000
+CHUNKS_PER_CHECKPOINT = 10
 
 def write_prior_file(demand_data):
-    '''Writes prior belief model to csv file'''
-    text = ""
-    for pixel in demand_data:
-        day_data = demand_data[pixel]
-        for day_code in day_data:
-            time_block_dict = day_data[day_code]
-            for block in time_block_dict:
-                value = time_block_dict[block]
-                text += ",".join([str(pixel), str(day_code), str(block), str(value)]) + "\n"
-    output_file = open("../csv/prior_demand/priors.csv", "w")
-    output_file.write(text)
-    output_file.close()
-
-def read_prior_file():
-    '''Reads in the prior beilef model from csv'''
-    demand_data = dict()
-    with open("../csv/prior_demand/priors.csv", "rb") as input_file:
-        print "Reading demand priors" # 16,783,200
-        counter = 0
-        for row in input_file:
-            items = row.replace(")", "").replace("(", "").\
-                    replace(" ", "").replace("\n", "").split(",")
-            x_coord, y_coord, \
-            day_code, time_block, \
-            prior_beta, demand_value = [int(item) for item in items]
-
-            pixel = (x_coord, y_coord)
-            if pixel not in demand_data:
-                demand_data[pixel] = dict()
-            if day_code not in demand_data[pixel]:
-                demand_data[pixel][day_code] = dict()
-            if time_block not in demand_data[pixel][day_code]:
-                demand_data[pixel][day_code][time_block] = (demand_value, prior_beta)
-            counter += 1
-        print "Done reading priors"
-    return demand_data
+    '''Writes prior belief model to the binary prior files'''
+    demand_data.save_npy(generic_ops.priors_fp())
+
+def convert_prior_file():
+    '''Convert priors.csv to the binary prior files, if not done yet'''
+    prefix = generic_ops.priors_fp()
+    if Path(prefix + "_value.npy").is_file():
+        return
+    print "Converting demand priors to binary" # 16,783,200
+    demand_data = BeliefStore().load_csv(prefix + ".csv")
+    if demand_data.left_out > 0:
+        print "Left out %s prior rows outside of the grid" % demand_data.left_out
+    demand_data.save_npy(prefix)
+    print "Done converting priors"
+
+def read_prior_file(mmap_mode="r"):
+    '''Memory-map the prior belief model.
+       "r" for experiments that only read it, "c" (copy-on-write) for learning'''
+    convert_prior_file()
+    return BeliefStore().load_npy(generic_ops.priors_fp(), mmap_mode)
 
 
 def initialize_pixel_prior(data, pickup_pixel, prior_beta):
     '''Create initial Beliefs matrix'''
-    time_blocks_per_day = 48
-    day_codes_per_week = 2
-    data[pickup_pixel] = dict()
     # weekday = 0; weekend = 1
-    for day in range(day_codes_per_week):
-        data[pickup_pixel][day] = dict()
-        for time_block in range(time_blocks_per_day):
-            data[pickup_pixel][day][time_block] = (0, prior_beta)
-    return data
+    return data.initialize_pixel(pickup_pixel, prior_beta)
 
 def update_belief_model(trip, priors, betas):
     '''Update belief matrix with a new trip'''
     initial_beta = betas['initial'] # 10
     beta_obs = betas['obs'] # 1
 
+    if not pixel_ops.in_grid(*trip.pickup_pixel):
+        priors.left_out += 1
+        return priors
+
     time_block = generic_ops.get_time_block_from_time(trip.pickup_request_time)
     day_code = generic_ops.get_day_code(trip.day_of_week)
 
-    if trip.pickup_pixel not in priors.keys():
+    if trip.pickup_pixel not in priors:
         priors = initialize_pixel_prior(priors, trip.pickup_pixel, initial_beta)
 
-    prior_demand_value, prior_beta = priors[trip.pickup_pixel][day_code][time_block]
+    prior_demand_value, prior_beta = priors.get(trip.pickup_pixel, day_code, time_block)
 
     observation_value = trip.occupancy
 
@@ -87,31 +84,111 @@ def update_belief_model(trip, priors, betas):
                               prior_beta + \
                               observation_value*beta_obs) / posterior_beta
 
-    priors[trip.pickup_pixel][day_code][time_block] = posterior_demand_value, posterior_beta
+    priors.set(trip.pickup_pixel, day_code, time_block, posterior_demand_value, posterior_beta)
+
+    return priors
+
+def update_belief_model_batch(columns, start, stop, priors, betas):
+    '''update_belief_model for rows start to stop of trip store columns, in one pass'''
+    pickup_x = np.asarray(columns['oX'][start:stop], dtype=int)
+    pickup_y = np.asarray(columns['oY'][start:stop], dtype=int)
+    inside = pixel_ops.in_grid(pickup_x, pickup_y)
+    priors.left_out += len(inside) - int(np.count_nonzero(inside))
+    pickup_x, pickup_y = pickup_x[inside], pickup_y[inside]
+    request_time = np.asarray(columns['pickup_request_time'][start:stop], dtype=int)[inside]
+    day_of_week = np.asarray(columns['day_of_week'][start:stop], dtype=int)[inside]
+
+    # generic_ops.get_time_block_from_time and get_day_code on arrays
+    time_block = ((request_time % 86400) // 60) // 30
+    day_code = np.where((day_of_week >= 1) & (day_of_week <= 5), 0, 1)
+
+    priors.initialize_pixels(pickup_x, pickup_y, betas['initial'])
+    return priors.observe(pickup_x, pickup_y, day_code, time_block,
+                          columns['occupancy'][start:stop][inside], betas['obs'])
+
+def update_belief_model_tick(trips, priors, betas):
+    '''Update belief matrix with the requests of one tick, a short list of trips.
+       Observations are totalled per cell and each cell is updated once, in the
+       closed form of BeliefStore.observe. Plain Python, batches are small.'''
+    initial_beta = betas['initial']
+    beta_obs = betas['obs']
+
+    totals = dict() # (pickup_pixel, day_code, time_block) -> [count, sum of occupancy]
+    for trip in trips:
+        if not pixel_ops.in_grid(*trip.pickup_pixel):
+            priors.left_out += 1
+            continue
+        time_block = generic_ops.get_time_block_from_time(trip.pickup_request_time)
+        day_code = generic_ops.get_day_code(trip.day_of_week)
+        total = totals.setdefault((trip.pickup_pixel, day_code, time_block), [0, 0])
+        total[0] += 1
+        total[1] += trip.occupancy
+
+    for (pickup_pixel, day_code, time_block), (count, observation_sum) in totals.iteritems():
+        if pickup_pixel not in priors:
+            priors = initialize_pixel_prior(priors, pickup_pixel, initial_beta)
+        prior_demand_value, prior_beta = priors.get(pickup_pixel, day_code, time_block)
+        posterior_beta = prior_beta + count * beta_obs
+        posterior_demand_value = (prior_demand_value * prior_beta + \
+                                  observation_sum * beta_obs) / posterior_beta
+        priors.set(pickup_pixel, day_code, time_block, posterior_demand_value, posterior_beta)
 
     return priors
 
+def checkpoint_fp():
+    '''Learned priors with the rows of each cleaned source they include'''
+    return generic_ops.priors_fp() + "_checkpoint.npz"
+
+def read_learning_progress():
+    '''Rows of each cleaned source in the checkpoint'''
+    if not Path(checkpoint_fp()).is_file():
+        return dict()
+    with np.load(checkpoint_fp()) as checkpoint:
+        return dict(zip(checkpoint['sources'].tolist(), checkpoint['rows'].tolist()))
+
+def write_checkpoint(demand_data, progress):
+    '''Save the priors and the rows they include in one step, then export the priors'''
+    sources = sorted(progress)
+    demand_data.save_npz(checkpoint_fp(),
+                         sources=np.array(sources, dtype=str),
+                         rows=np.array([progress[source] for source in sources], dtype=np.int64))
+    write_prior_file(demand_data)
+
 def offline_demand_learning(raw_data_file_name):
-    '''Run offline learning'''
+    '''Run offline learning.
+       Resumes from the last checkpoint, so rerunning after new rows or new
+       sources only learns what is new.'''
     cleaned_filepath = generic_ops.cleaned_fp(raw_data_file_name)
-    historial_trip_log = trip_ops.read_cleaned_trips(cleaned_filepath)
+    columns = TripStore(cleaned_filepath).columns
+    number_of_trips = len(columns['trip_id'])
 
     betas = dict()
     betas['initial'] = 1
     betas['obs'] = 1
 
-    # Create blank demand data matrix
-    demand_data = dict() # Days
-
-    # Now iterate through the trip log and get the demand...
-    for trip in historial_trip_log.values():
-
-        # For debug
-        if trip.trip_id % 10000 == 0:
-            print trip.trip_id
-
-        # Add value to corresponding cell
-        demand_data = update_belief_model(trip, demand_data, betas)
-
-    write_prior_file(demand_data)
+    # Fold into checkpointed priors if there are any, otherwise start blank,
+    # sized to the pickup pixels seen
+    progress = read_learning_progress()
+    if len(progress) > 0:
+        demand_data = BeliefStore().load_npz(checkpoint_fp())
+    else:
+        demand_data = BeliefStore()
+    if number_of_trips > 0:
+        demand_data.grow(min(int(columns['oX'].max()) + 1, pixel_ops.GRID_X_SIZE),
+                         min(int(columns['oY'].max()) + 1, pixel_ops.GRID_Y_SIZE))
+
+    start = progress.get(raw_data_file_name, 0)
+    chunks = 0
+    while start < number_of_trips:
+        stop = min(start + TRIPS_PER_CHUNK, number_of_trips)
+        demand_data = update_belief_model_batch(columns, start, stop, demand_data, betas)
+        progress[raw_data_file_name] = start = stop
+        chunks += 1
+        print "Learned %s of %s trips" % (stop, number_of_trips)
+        if chunks % CHUNKS_PER_CHECKPOINT == 0:
+            write_checkpoint(demand_data, progress)
+
+    if demand_data.left_out > 0:
+        print "Left out %s trips outside of the grid" % demand_data.left_out
+    write_checkpoint(demand_data, progress)
     return
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+    File: dispatch_queue.py
+    Author: Keith Gladstone
+
+    Description:
+        Priority queue of trips waiting for dispatch, keyed on pickup time.
+        Replaces the sorted deque (deque_put_in_place / deque_replace)
+        that backed the trip_buffer.
+    Notes:
+        Entries are [pickup_time, -sequence, trip] lists on a heap.
+        Among equal pickup times the most recently pushed trip comes out
+        first, which is where deque_put_in_place used to insert it.
+        Replacing a trip swaps it into the existing entry, so it keeps
+        its place in line just like deque_replace did.
+"""
+import heapq
+from math import floor
+
+class DispatchQueue(object):
+    '''Heap of (trip, pickup_time) pairs with replace-by-trip.'''
+    def __init__(self):
+        self.heap = list()
+        self.entries = dict() # trip_id -> heap entry
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, trip, pickup_time):
+        '''Enqueue a trip to be dispatched at pickup_time. O(log n)'''
+        entry = [pickup_time, -self.sequence, trip]
+        self.sequence += 1
+        self.entries[trip.trip_id] = entry
+        heapq.heappush(self.heap, entry)
+        return self
+
+    def peek(self):
+        '''Get the (trip, pickup_time) pair that is next to dispatch.'''
+        pickup_time, _, trip = self.heap[0]
+        return trip, pickup_time
+
+    def pop(self):
+        '''Dequeue the (trip, pickup_time) pair that is next to dispatch. O(log n)'''
+        pickup_time, _, trip = heapq.heappop(self.heap)
+        del self.entries[trip.trip_id]
+        return trip, pickup_time
+
+    def pop_due(self, dispatch_time):
+        '''Dequeue every pair whose pickup time is due at dispatch_time, in order.'''
+        while len(self.heap) > 0 and floor(self.heap[0][0]) <= floor(dispatch_time):
+            yield self.pop()
+
+    def replace(self, old_trip, new_trip, pickup_time):
+        '''Put new_trip in old_trip's place if old_trip is queued at pickup_time. O(1)'''
+        entry = self.entries.get(old_trip.trip_id)
+        if entry is None or entry[2] is not old_trip or entry[0] != pickup_time:
+            return self
+        del self.entries[old_trip.trip_id]
+        entry[2] = new_trip
+        self.entries[new_trip.trip_id] = entry
+        return self
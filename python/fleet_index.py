@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+    File: fleet_index.py
+    Author: Keith Gladstone
+
+    Description:
+        Spatial index over the fleet, keyed on the pixel grid.
+        Answers "which vehicle arrives soonest at this pixel" without
+        scanning every vehicle in the Vehicle Log.
+    Notes:
+        Vehicles that are free by the current request time ("idle")
+        are bucketed by pixel and searched in rings of increasing
+        Manhattan distance. Vehicles that are still busy are kept
+        sorted by the time they become free.
+        Ties are broken by lowest vehicle_id, which is the order the
+        linear scan in handler.vehicle_min_arrival_time visits them.
+"""
+from bisect import bisect_left, insort
+
+import pixel_ops
+
+class FleetIndex(object):
+    '''Pixel buckets of vehicles plus a free-time ordering.'''
+    def __init__(self):
+        self.location = dict()
+        self.free_time = dict()
+        self.pixel_buckets = dict()  # every vehicle, by latest location
+        self.idle_buckets = dict()   # vehicles free by the watermark
+        self.busy = list()           # sorted (free_time, vehicle_id)
+        self.watermark = None        # latest request time seen
+
+    def __len__(self):
+        return len(self.location)
+
+    def is_idle(self, free_time):
+        '''Is a vehicle with this free time idle at the watermark?'''
+        return self.watermark is not None and free_time <= self.watermark
+
+    def add(self, vehicle_id, location, free_time):
+        '''Register a vehicle at its latest location and free time.'''
+        self.location[vehicle_id] = location
+        self.free_time[vehicle_id] = free_time
+        self.pixel_buckets.setdefault(location, set()).add(vehicle_id)
+        if self.is_idle(free_time):
+            self.idle_buckets.setdefault(location, set()).add(vehicle_id)
+        else:
+            insort(self.busy, (free_time, vehicle_id))
+
+    def remove(self, vehicle_id):
+        '''Unregister a vehicle.'''
+        location = self.location.pop(vehicle_id)
+        free_time = self.free_time.pop(vehicle_id)
+        discard_from_bucket(self.pixel_buckets, location, vehicle_id)
+        if self.is_idle(free_time):
+            discard_from_bucket(self.idle_buckets, location, vehicle_id)
+        else:
+            index = bisect_left(self.busy, (free_time, vehicle_id))
+            del self.busy[index]
+
+    def update(self, vehicle_id, location, free_time):
+        '''Move a vehicle to a new location and free time.'''
+        if vehicle_id in self.location:
+            if self.location[vehicle_id] == location and \
+               self.free_time[vehicle_id] == free_time:
+                return
+            self.remove(vehicle_id)
+        self.add(vehicle_id, location, free_time)
+
+    def advance(self, request_time):
+        '''Move the watermark forward, freeing vehicles that are done.'''
+        self.watermark = request_time
+        freed = 0
+        for free_time, vehicle_id in self.busy:
+            if free_time > request_time:
+                break
+            location = self.location[vehicle_id]
+            self.idle_buckets.setdefault(location, set()).add(vehicle_id)
+            freed += 1
+        del self.busy[:freed]
+
+    def rebuild(self, request_time):
+        '''Repartition idle/busy vehicles around an earlier watermark.'''
+        vehicles = [(vehicle_id, self.location[vehicle_id], self.free_time[vehicle_id])
+                    for vehicle_id in self.location]
+        self.__init__()
+        self.watermark = request_time
+        for vehicle_id, location, free_time in vehicles:
+            self.add(vehicle_id, location, free_time)
+
+    def min_arrival(self, pixel, request_time):
+        '''Get (vehicle_id, location, time_delay) of the soonest vehicle to pixel.
+           Returns the same vehicle as a full scan in vehicle_id order.'''
+        assert(len(self.location) > 0), "Fleet Index is empty"
+        if self.watermark is None or request_time >= self.watermark:
+            self.advance(request_time)
+        else:
+            self.rebuild(request_time)
+
+        # Vehicle is already there, use it
+        if pixel in self.pixel_buckets:
+            vehicle_id = min(self.pixel_buckets[pixel])
+            return vehicle_id, pixel, 0.0
+
+        champion = None
+        champion = self.nearest_idle(pixel, request_time, champion)
+        champion = self.nearest_busy(pixel, request_time, champion)
+        time_vehicle_would_arrive, vehicle_id = champion
+        time_delay = time_vehicle_would_arrive - request_time
+        return vehicle_id, self.location[vehicle_id], time_delay
+
+    def nearest_idle(self, pixel, request_time, champion):
+        '''Ring search over idle buckets, stopping once no ring can win.'''
+        pixel_x, pixel_y = pixel
+        idle_buckets = self.idle_buckets
+        distance = 1
+        pixels_probed = 0
+        while len(idle_buckets) > 0:
+            lower_bound = request_time + pixel_ops.time_of_travel((0, 0), (distance, 0))
+            if champion is not None and lower_bound > champion[0]:
+                break
+            # Rings cost more than what is left to look at: scan the buckets directly
+            pixels_probed += 4 * distance
+            if pixels_probed >= len(idle_buckets):
+                for location, vehicle_ids in idle_buckets.iteritems():
+                    champion = self.best_of_bucket(location, vehicle_ids, pixel,
+                                                   request_time, champion)
+                break
+            for offset_x in xrange(-distance, distance + 1):
+                offset_y = distance - abs(offset_x)
+                location = (pixel_x + offset_x, pixel_y + offset_y)
+                if location in idle_buckets:
+                    champion = self.best_of_bucket(location, idle_buckets[location],
+                                                   pixel, request_time, champion)
+                if offset_y != 0:
+                    location = (pixel_x + offset_x, pixel_y - offset_y)
+                    if location in idle_buckets:
+                        champion = self.best_of_bucket(location, idle_buckets[location],
+                                                       pixel, request_time, champion)
+            distance += 1
+        return champion
+
+    def nearest_busy(self, pixel, request_time, champion):
+        '''Scan busy vehicles by free time, stopping once none can win.'''
+        for free_time, vehicle_id in self.busy:
+            if champion is not None and free_time > champion[0]:
+                break
+            travel_time = pixel_ops.time_of_travel(self.location[vehicle_id], pixel)
+            arrival = max(free_time, request_time) + travel_time
+            if champion is None or (arrival, vehicle_id) < champion:
+                champion = (arrival, vehicle_id)
+        return champion
+
+    def best_of_bucket(self, location, vehicle_ids, pixel, request_time, champion):
+        '''Best (arrival, vehicle_id) among vehicles sharing a location.'''
+        travel_time = pixel_ops.time_of_travel(location, pixel)
+        for vehicle_id in vehicle_ids:
+            arrival = max(self.free_time[vehicle_id], request_time) + travel_time
+            if champion is None or (arrival, vehicle_id) < champion:
+                champion = (arrival, vehicle_id)
+        return champion
+
+def discard_from_bucket(buckets, location, vehicle_id):
+    '''Remove vehicle_id from a pixel bucket, dropping the bucket if empty.'''
+    bucket = buckets[location]
+    bucket.discard(vehicle_id)
+    if len(bucket) == 0:
+        del buckets[location]
+
+def build_fleet_index(vehicles_log):
+    '''Index every vehicle in the Vehicle Log (a FleetState) and link it to the index.'''
+    fleet_index = FleetIndex()
+    vehicles_log.register(fleet_index)
+    return fleet_index
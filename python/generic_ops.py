@@ -101,7 +101,7 @@ def deque_replace(deque_instance, old, new):
 
 def add_to_dict_of_lists(dictionary, key, value):
     '''Append a value to a list accessed in the hash table by a key'''
-    if key not in dictionary.keys():
+    if key not in dictionary:
         dictionary[key] = list()
     dictionary[key].append(value)
     return dictionary
@@ -125,6 +125,14 @@ def results_fp(raw_data_file_name, index):
     '''Get the default results filename'''
     return '../csv/results/' + raw_data_file_name + str(index) + "_results.csv"
 
+def metrics_fp(raw_data_file_name, index):
+    '''Get the default metrics timeline filename'''
+    return '../csv/results/' + raw_data_file_name + str(index) + "_metrics.npz"
+
 def cleaned_fp(raw_data_file_name):
     '''Get the default cleaned data filename'''
     return "../csv/cleaned/" + raw_data_file_name + "_cleanemy_dict.csv"
+
+def priors_fp():
+    '''Get the prefix of the default prior demand files'''
+    return "../csv/prior_demand/priors"
@@ -10,84 +10,90 @@
 """
 import csv
 import sys
-from collections import deque
 from math import floor
 
-from vehicle import Vehicle
+import numpy as np
+
+from vehicle import FleetState
+from fleet_index import build_fleet_index
+from dispatch_queue import DispatchQueue
+from pending_routes import PendingRouteIndex
+from trip_store import TripStore
+from metrics import MetricsAccumulator
 import trip_ops
 import generic_ops
 import pixel_ops
 import demand_learning
 
+# Right, up, left, down: the order of BeliefStore.directional_demand
+CARDINAL_X = np.array([1, 0, -1, 0])
+CARDINAL_Y = np.array([0, 1, 0, -1])
+
+# Pending routes per origin a request is tried against when constraints['batch_rideshare']
+MAX_BATCH_ROUTES = 4
+
 def local_demand_predictor(current_p, day, time_block, beliefs, local_demand_degree):
     '''Determines optimal cardinal direction to move vehicle.'''
     current_x, current_y = current_p
-    directional_demand = [0, 0, 0, 0] # right, up, left, down
     target_pixel = [(current_x + 1, current_y),
                     (current_x, current_y + 1),
                     (current_x - 1, current_y),
                     (current_x, current_y - 1)]
-    superpixel = pixel_ops.get_superpixel_degree_n(current_p, local_demand_degree)
-
-    for city_pixel, pixel_demand in beliefs.iteritems():
-        if city_pixel in superpixel:
-            (pixel_x, pixel_y) = city_pixel
-            demand_value = pixel_demand[generic_ops.get_day_code(day)][time_block][0]
-            if pixel_x > current_x:
-                directional_demand[0] += demand_value
-            if pixel_y > current_y:
-                directional_demand[1] += demand_value
-            if pixel_x < current_x:
-                directional_demand[2] += demand_value
-            if pixel_y < current_y:
-                directional_demand[3] += demand_value
+    directional_demand = beliefs.directional_demand(current_p,
+                                                    generic_ops.get_day_code(day),
+                                                    time_block,
+                                                    local_demand_degree) # right, up, left, down
     return target_pixel[max((v, i) for i, v in enumerate(directional_demand))[1]]
 
+def local_demand_predictor_batch(x_coords, y_coords, day, time_block, beliefs,
+                                 local_demand_degree):
+    '''local_demand_predictor for arrays of pixels, returns the target x and y arrays.'''
+    directional_demand = beliefs.directional_demand_batch(x_coords, y_coords,
+                                                          generic_ops.get_day_code(day),
+                                                          time_block,
+                                                          local_demand_degree)
+    # Search the directions back to front so ties go to the last one, like max((v, i))
+    direction = 3 - np.argmax(directional_demand[:, ::-1], axis=1)
+    return x_coords + CARDINAL_X[direction], y_coords + CARDINAL_Y[direction]
+
 def handle_empty_repositioning(vehicles_log, time, beliefs, local_demand_degree):
-    '''Moves vehicle using LEVRS.'''
+    '''Moves vehicle using LEVRS.
+       All empty vehicles are predicted and moved together in one vectorized pass.'''
     time_block = generic_ops.get_time_block_from_time(time)
     day_of_week = generic_ops.get_day_of_week_from_time(time)
 
-    empty_vehicles = list()
-    for vehicle_id in vehicles_log:
-        vehicle = vehicles_log[vehicle_id]
-        last_pinged_time = vehicle.time_of_last_ping
-        if last_pinged_time < time:
-            empty_vehicles.append(vehicle)
-    if len(empty_vehicles) == 0:
+    empty_vehicle_ids = vehicles_log.idle_vehicle_ids(time)
+    if len(empty_vehicle_ids) == 0:
         return vehicles_log
-    for empty_vehicle in empty_vehicles:
-        current_loc = empty_vehicle.most_recently_pinged_location
-        incremental_reposition = local_demand_predictor(\
-            current_loc, day_of_week, time_block, beliefs, local_demand_degree)
-        vehicles_log[empty_vehicle.vehicle_id] = \
-            empty_vehicle.empty_reposition(time, incremental_reposition)
-    return vehicles_log
+    target_x, target_y = local_demand_predictor_batch(\
+        vehicles_log.x[empty_vehicle_ids], vehicles_log.y[empty_vehicle_ids],
+        day_of_week, time_block, beliefs, local_demand_degree)
+    return vehicles_log.empty_reposition(empty_vehicle_ids, target_x, target_y, time)
 
 def initial_vehicle_log(trip_log, fleet_size):
     '''Create the initial vehicles_log.'''
     list_trip_log = generic_ops.list_from_dict(trip_log)
     first_n_trips = list_trip_log[:fleet_size]
-    vehicles_log = dict()
+    vehicles_log = FleetState(len(first_n_trips))
     vehicle_id = 0
     for trip_id, trip in first_n_trips:
-        cumulative_person_miles = trip_ops.get_person_miles_of_joined_trip(trip_log, trip_id)
-        cumulative_vehicle_miles = trip_ops.get_vehicle_miles_of_joined_trip(trip_log, trip_id)
-        vehicle = Vehicle(\
-            vehicle_id,
-            [trip.trip_id],
-            0,
-            trip.dropoff_pixel,
-            trip.dropoff_time,
-            cumulative_person_miles,
-            cumulative_vehicle_miles\
-        )
-        vehicles_log[vehicle_id] = vehicle
+        vehicle = vehicles_log[vehicle_id]
+        vehicle.latest_trip = trip.trip_id
+        vehicle.most_recently_pinged_location = trip.dropoff_pixel
+        vehicle.time_of_last_ping = trip.dropoff_time
+        vehicle.cumulative_person_miles = \
+            trip_ops.get_person_miles_of_joined_trip(trip_log, trip_id)
+        vehicle.cumulative_vehicle_miles = \
+            trip_ops.get_vehicle_miles_of_joined_trip(trip_log, trip_id)
         vehicle_id += 1
     return vehicles_log
 
 def find_best_common_origin_seq(trip_list, max_circuity, max_stops):
     '''Given a list of trips, find the best rideshared route.'''
+    # Distinct stops do not depend on the order, so reject before solving the route
+    if len(set(trip.dropoff_pixel for trip in trip_list)) > max_stops:
+        return None
+
     path = pixel_ops.hamilton_of_trip_list(trip_list)[1]
     distinct_stops = dict()
 
@@ -113,7 +119,7 @@ def find_best_common_origin_seq(trip_list, max_circuity, max_stops):
 
 def predispatched_trips(trip_log, trip_location_hash_table, pickup_pixel):
     '''Get the predispatched trips from a certain pickup_pixel.'''
-    trip = list(trip_location_hash_table[pickup_pixel])[-1][1]
+    trip = trip_location_hash_table.tail(pickup_pixel)
     return trip_ops.get_all_joined_trips(trip_log, trip.trip_id)
 
 def optimal_route(trip, trip_log, trip_location_hash_table,
@@ -129,9 +135,9 @@ def optimal_route(trip, trip_log, trip_location_hash_table,
 
 def sync_joined_trips(trip_log, trip_id, dispatch_time):
     '''Sync the data for rideshared trips.'''
-    trip = trip_ops.get_trip(trip_log, trip_id)
+    legs = trip_ops.get_route(trip_log, trip_id).legs
+    trip = legs[0]
     vehicle_id = trip.vehicle_id
-    joined_trip_id = trip.joined_trip_id
     pickup_location = trip.pickup_pixel
 
     trip.pickup_time = dispatch_time
@@ -141,16 +147,10 @@ def sync_joined_trips(trip_log, trip_id, dispatch_time):
 
     # For each subsequent trip, update the time elapsed to reach destination
     # Update the vehicle id
-    while True:
-        joined_trip = trip_ops.get_trip(trip_log, joined_trip_id)
+    for joined_trip in legs[1:]:
         time_elapsed += pixel_ops.time_of_travel(trip.dropoff_pixel, joined_trip.dropoff_pixel)
-        joined_trip = joined_trip.set_actual_t(dispatch_time, dispatch_time + time_elapsed)
-        joined_trip = joined_trip.set_vehicle(vehicle_id)
-        trip_id = joined_trip_id
-        joined_trip_id = joined_trip.joined_trip_id
-
-        if joined_trip_id == trip_id:
-            break
+        joined_trip.set_actual_t(dispatch_time, dispatch_time + time_elapsed)
+        joined_trip.set_vehicle(vehicle_id)
 
     return trip_log
 
@@ -185,12 +185,21 @@ def get_vehicles_latest_trips(vehicles_log):
             (vehicle.most_recently_pinged_location, vehicle.time_of_last_ping)
     return vehicle_locations
 
-def vehicle_min_arrival_time(trip_log, trip_id, vehicles_log):
+def vehicle_min_arrival_time(trip_log, trip_id, vehicles_log, fleet_index=None):
     '''Get the vehicle that will arrive soonest for trip_id.'''
-    vehicles_latest_trips = get_vehicles_latest_trips(vehicles_log)
     trip = trip_ops.get_trip(trip_log, trip_id)
     request_time = trip.pickup_request_time
 
+    # Sublinear lookup, same vehicle as the scan below
+    if fleet_index is not None:
+        vehicle_id, pre_repositioned_location, time_delay = \
+            fleet_index.min_arrival(trip.pickup_pixel, request_time)
+        return {"vehicle_id" : vehicle_id,
+                "pre_repositioned_location" : pre_repositioned_location,
+                "time_delay" : time_delay}
+
+    vehicles_latest_trips = get_vehicles_latest_trips(vehicles_log)
+
     # Get the vehicle that can arrive soonest (with travel estimate)
     closest_vehicle_info = None
     min_time = sys.maxint
@@ -200,7 +209,9 @@ def vehicle_min_arrival_time(trip_log, trip_id, vehicles_log):
 
         # Vehicle is already there, use it
         if travel_time == 0.0:
-            return (vehicle_id, pre_repositioned_location, 0.0)
+            return {"vehicle_id" : vehicle_id,
+                    "pre_repositioned_location" : pre_repositioned_location,
+                    "time_delay" : 0.0}
 
         time_vehicle_would_arrive = \
             max(pre_repositioned_time, request_time) + travel_time
@@ -217,7 +228,7 @@ def vehicle_min_arrival_time(trip_log, trip_id, vehicles_log):
                 Travel Time: %s
                 Time Vehicle Would Arrive Here: %s
                 """ % (str(time_delay),
-                       str(trip.__dict__),
+                       str(trip.to_dict()),
                        str(pre_repositioned_time),
                        str(pre_repositioned_location),
                        str(request_time),
@@ -230,13 +241,14 @@ def vehicle_min_arrival_time(trip_log, trip_id, vehicles_log):
     assert(min_time != sys.maxint), "Closest Vehicle not selected"
     return closest_vehicle_info
 
-def get_vehicle_for_this_trip(trip_log, trip_id, vehicles_log):
+def get_vehicle_for_this_trip(trip_log, trip_id, vehicles_log, fleet_index=None):
     '''Get the vehicle to be assigned for this trip.'''
-    vehicle = vehicle_min_arrival_time(trip_log, trip_id, vehicles_log)
+    vehicle = vehicle_min_arrival_time(trip_log, trip_id, vehicles_log, fleet_index)
     return vehicle
 
 def do_request_new_vehicle(trip_log, trip_id, vehicles_log,
-                           constraints, trip_buffer, trip_location_hash_table):
+                           constraints, trip_buffer, trip_location_hash_table,
+                           fleet_index=None):
     '''Request a new vehicle for this trip, handle info'''
     # Helper variables
     trip = trip_ops.get_trip(trip_log, trip_id)
@@ -245,36 +257,29 @@ def do_request_new_vehicle(trip_log, trip_id, vehicles_log,
     # Need to a request a new vehicle for this trip
     #   (1) Identify which vehicle is needed
     #   (2) Update data structures to link this trip request to that vehicle and "send vehicle"
-    vehicle_for_this_trip = get_vehicle_for_this_trip(trip_log, trip_id, vehicles_log)
+    vehicle_for_this_trip = get_vehicle_for_this_trip(trip_log, trip_id,
+                                                      vehicles_log, fleet_index)
     trip_log, vehicles_log = send_vehicle_for_this_request(trip_log, trip_id,
                                                            vehicle_for_this_trip,
                                                            vehicles_log, constraints)
 
     # We want to put this trip, therefore, in the trip fulfillment queue and location dict
-    trip_buffer = generic_ops.deque_put_in_place(trip_buffer, (trip, trip.pickup_time))
-    trip_location_hash_table[pickup_pixel].append((dropoff_pixel, trip))
+    trip_buffer.push(trip, trip.pickup_time)
+    trip_location_hash_table.append(pickup_pixel, dropoff_pixel, trip)
 
     return trip_log, vehicles_log
 
 def is_this_vehicles_latest_loc(trip_log, vehicles_log,
                                 trip_location_hash_table, pickup_pixel):
     '''Is the vehicle's latest scheduled trip the latest trip scheduled at this pickup pixel?'''
-    if len(trip_location_hash_table[pickup_pixel]) == 0:
+    if pickup_pixel not in trip_location_hash_table:
         return False
-    the_trip_scheduled_from_this_origin = trip_location_hash_table[pickup_pixel][-1]
-    trip = the_trip_scheduled_from_this_origin[1]
+    trip = trip_location_hash_table.tail(pickup_pixel)
     last_common_origin_trip = trip_ops.get_last_joined_trip(trip_log, trip.trip_id)
     vehicle_id = last_common_origin_trip.vehicle_id
     the_latest_trip_scheduled_with_this_vehicle = vehicles_log[vehicle_id].latest_trip
     return str(the_latest_trip_scheduled_with_this_vehicle) == str(trip.trip_id)
 
-def get_joined_trip_occupants(trip_legs):
-    '''Get the number of total occupants for all trip legs of a rideshared trip'''
-    total = 0
-    for trip_leg in trip_legs:
-        total += trip_leg.occupancy
-    return total
-
 def common_origin_validation(trip_location_hash_table, trip_log,
                              vehicles_log, new_trip_request, constraints):
     '''Run the common origin validation process'''
@@ -285,7 +290,7 @@ def common_origin_validation(trip_location_hash_table, trip_log,
     pickup_pixel = new_trip_request.pickup_pixel
 
     there_exists_undispatched_vehicle_from_this_origin = \
-        len(trip_location_hash_table[pickup_pixel]) > 0
+        pickup_pixel in trip_location_hash_table
 
     # If there exists a vehicle from this origin
     if there_exists_undispatched_vehicle_from_this_origin:
@@ -301,16 +306,12 @@ def common_origin_validation(trip_location_hash_table, trip_log,
 
         else:
             # Get pickup time of the trip
-            first_leg_of_trip_here = list(trip_location_hash_table[pickup_pixel])[0][1]
+            first_leg_of_trip_here = trip_location_hash_table.head(pickup_pixel)
             if new_trip_request.pickup_request_time > first_leg_of_trip_here.pickup_time:
                 request_new_vehicle = True
             else:
                 # SUBJECT TO vehicle_size CONSTRAINT
-                current_joined_trip = [that_trip[1] \
-                                        for that_trip \
-                                        in list(trip_location_hash_table[pickup_pixel])]
-
-                current_vehicle_occupancy = get_joined_trip_occupants(current_joined_trip)
+                current_vehicle_occupancy = trip_location_hash_table.occupancy(pickup_pixel)
 
                 vehicle_would_exceed_capacity = \
                     current_vehicle_occupancy + new_trip_request.occupancy > vehicle_size
@@ -328,13 +329,13 @@ def common_origin_validation(trip_location_hash_table, trip_log,
 
     return request_new_vehicle, optimal_order
 
-def resequence_joined_trip_ids(trip_log, ordered_joined_trips):
-    '''Resync joined trip ids'''
-    for i in range(0, len(ordered_joined_trips) - 1):
-        trip = ordered_joined_trips[i]
-        trip.joined_trip_id = ordered_joined_trips[i + 1].trip_id
-    last_trip = ordered_joined_trips[-1]
-    last_trip.joined_trip_id = last_trip.trip_id
+def resequence_joined_trip_ids(trip_log, ordered_joined_trips, route=None):
+    '''Resync joined trip ids, and the route the trips were joined on, if any'''
+    if route is None:
+        route = trip_ops.Route(ordered_joined_trips)
+    else:
+        route.resequence(ordered_joined_trips)
+    route.attach()
     return trip_log
 
 def greedy_common_origin_scheduler(trip_log, vehicles_log, trip_location_hash_table,
@@ -343,26 +344,129 @@ def greedy_common_origin_scheduler(trip_log, vehicles_log, trip_location_hash_ta
     pickup_pixel = new_trip_request.pickup_pixel
     optimal_order_CO_destinations = [trip[1] for trip in optimal_order]
     new_first_trip_of_route = optimal_order_CO_destinations[0]
-    scheduled_trip_from_this_origin = list(trip_location_hash_table[pickup_pixel])[-1][1]
+    scheduled_trip_from_this_origin = trip_location_hash_table.tail(pickup_pixel)
     pickup_time = scheduled_trip_from_this_origin.pickup_time
     vehicle_id = scheduled_trip_from_this_origin.vehicle_id
 
-    trip_log = resequence_joined_trip_ids(trip_log, optimal_order_CO_destinations)
+    route = trip_ops.get_route(trip_log, scheduled_trip_from_this_origin.trip_id)
+    trip_log = resequence_joined_trip_ids(trip_log, optimal_order_CO_destinations, route)
 
-    vehicles_log[vehicle_id] = \
-        vehicles_log[vehicle_id].replace_last_trip(new_first_trip_of_route)
+    vehicles_log[vehicle_id].replace_last_trip(new_first_trip_of_route)
     new_trip_request.set_vehicle(vehicle_id)
 
     sync_joined_trips(trip_log, new_first_trip_of_route.trip_id, pickup_time)
-    generic_ops.deque_replace(trip_buffer,
-                              (scheduled_trip_from_this_origin, pickup_time),
-                              (new_first_trip_of_route, pickup_time))
-    trip_location_hash_table[pickup_pixel].popleft()
-    trip_location_hash_table[pickup_pixel].append((optimal_order[0][0], new_first_trip_of_route))
+    trip_buffer.replace(scheduled_trip_from_this_origin, new_first_trip_of_route, pickup_time)
+    trip_location_hash_table.replace(pickup_pixel, scheduled_trip_from_this_origin,
+                                     optimal_order[0][0], new_first_trip_of_route)
     return trip_log, vehicles_log, trip_location_hash_table
 
+def route_with_request(vehicles_log, route, new_trip_request, constraints):
+    '''Optimal order of a pending route's legs plus the request, None if the route
+       cannot take it. Same checks as common origin validation, on this route alone.'''
+    first_leg = route.first
+    vehicle_id = route.last.vehicle_id
+    if vehicles_log[vehicle_id].latest_trip != first_leg.trip_id:
+        return None
+    if new_trip_request.pickup_request_time > first_leg.pickup_time:
+        return None
+    if route.occupancy + new_trip_request.occupancy > constraints['vehicle_size']:
+        return None
+    optimal_order = find_best_common_origin_seq(route.legs + [new_trip_request],
+                                                constraints['max_circuity'],
+                                                constraints['max_stops'])
+    if optimal_order is None or optimal_order[0][1].pickup_request_time > first_leg.pickup_time:
+        return None
+    return optimal_order
+
+def join_route(trip_log, vehicles_log, trip_location_hash_table, trip_buffer,
+               route, new_trip_request, optimal_order):
+    '''Add the request to a pending route, in the route's place'''
+    pickup_pixel = new_trip_request.pickup_pixel
+    optimal_order_CO_destinations = [trip[1] for trip in optimal_order]
+    new_first_trip_of_route = optimal_order_CO_destinations[0]
+    scheduled_trip_from_this_origin = route.first
+    pickup_time = scheduled_trip_from_this_origin.pickup_time
+    vehicle_id = scheduled_trip_from_this_origin.vehicle_id
+
+    trip_log = resequence_joined_trip_ids(trip_log, optimal_order_CO_destinations, route)
+
+    vehicles_log[vehicle_id].replace_last_trip(new_first_trip_of_route)
+    new_trip_request.set_vehicle(vehicle_id)
+
+    sync_joined_trips(trip_log, new_first_trip_of_route.trip_id, pickup_time)
+    trip_buffer.replace(scheduled_trip_from_this_origin, new_first_trip_of_route, pickup_time)
+    trip_location_hash_table.replace(pickup_pixel, scheduled_trip_from_this_origin,
+                                     optimal_order[0][0], new_first_trip_of_route)
+    return trip_log, vehicles_log
+
+def match_requests_in_batch(trip_log, vehicles_log, requests, constraints,
+                            trip_location_hash_table, trip_buffer, fleet_index=None):
+    '''Pool a tick's requests together, origin by origin.
+       Largest requests go first, each joins the fullest of the latest
+       MAX_BATCH_ROUTES routes at its origin that can take it (best fit decreasing),
+       otherwise it gets a new vehicle. Each request solves at most
+       MAX_BATCH_ROUTES routes, so a tick costs linear time in its requests.'''
+    origins = list()
+    requests_by_origin = dict()
+    for trip in requests:
+        if trip.pickup_pixel not in requests_by_origin:
+            requests_by_origin[trip.pickup_pixel] = list()
+            origins.append(trip.pickup_pixel)
+        requests_by_origin[trip.pickup_pixel].append(trip)
+
+    for pickup_pixel in origins:
+        for trip in sorted(requests_by_origin[pickup_pixel], key=lambda trip: -trip.occupancy):
+            best_route, best_order = None, None
+            if constraints['greedy_common_origin']:
+                for first_leg in trip_location_hash_table.latest(pickup_pixel, MAX_BATCH_ROUTES):
+                    route = trip_ops.get_route(trip_log, first_leg.trip_id)
+                    optimal_order = route_with_request(vehicles_log, route, trip, constraints)
+                    if optimal_order is not None and \
+                       (best_route is None or route.occupancy > best_route.occupancy):
+                        best_route, best_order = route, optimal_order
+            if best_route is None:
+                trip_log, vehicles_log = \
+                    do_request_new_vehicle(trip_log,
+                                           trip.trip_id,
+                                           vehicles_log,
+                                           constraints,
+                                           trip_buffer,
+                                           trip_location_hash_table,
+                                           fleet_index)
+            else:
+                trip_log, vehicles_log = \
+                    join_route(trip_log, vehicles_log, trip_location_hash_table,
+                               trip_buffer, best_route, trip, best_order)
+    return trip_log, vehicles_log
+
+def test_match_requests_in_batch():
+    '''Three requests from one origin and one vehicle: the two that fit the
+       circuity limit share a route, the third gets a route of its own'''
+    constraints = {'departure_delay': 60, 'vehicle_size': 4, 'max_circuity': 1.5,
+                   'max_stops': 5, 'greedy_common_origin': True}
+    requests = [trip_ops.Trip(1, (0, 0), (3, 0), 10, 100, 10, 100, 1, 0),
+                trip_ops.Trip(2, (0, 0), (5, 0), 10, 100, 10, 100, 2, 0),
+                trip_ops.Trip(3, (0, 0), (0, 4), 10, 100, 10, 100, 1, 0)]
+    trip_log = dict((trip.trip_id, trip) for trip in requests)
+    vehicles_log = FleetState(1)
+    trip_location_hash_table = PendingRouteIndex()
+    trip_buffer = DispatchQueue()
+    trip_log, vehicles_log = match_requests_in_batch(trip_log, vehicles_log, requests,
+                                                     constraints, trip_location_hash_table,
+                                                     trip_buffer)
+    assert(trip_location_hash_table.count((0, 0)) == 2), "Expected two routes"
+    shared = trip_ops.get_route(trip_log, trip_location_hash_table.head((0, 0)).trip_id)
+    assert([leg.trip_id for leg in shared.legs] == [1, 2]), "Shared route out of dropoff order"
+    assert(shared.occupancy == 3), "Shared route occupancy"
+    assert(len(set(leg.pickup_time for leg in shared.legs)) == 1), "Legs leave together"
+    alone = trip_ops.get_route(trip_log, trip_location_hash_table.tail((0, 0)).trip_id)
+    assert([leg.trip_id for leg in alone.legs] == [3]), "Third request should ride alone"
+    assert(len(trip_buffer) == 2), "Expected one dispatch per route"
+    print [[leg.trip_id for leg in route.legs] for route in (shared, alone)]
+
 def process_request(trip_log, trip, vehicles_log,
-                    constraints, trip_location_hash_table, trip_buffer):
+                    constraints, trip_location_hash_table, trip_buffer,
+                    fleet_index=None):
     '''Run the general process for a single trip request'''
     greedy = constraints['greedy_common_origin']
     request_new_vehicle = True # default true, but turn false if vehicle is available
@@ -371,11 +475,6 @@ def process_request(trip_log, trip, vehicles_log,
     new_trip_request = trip
     pickup_pixel = new_trip_request.pickup_pixel
 
-    # If the origin point has NOT been accounted for yet then set it up as
-    # an empty deque of destination points
-    if pickup_pixel not in trip_location_hash_table.keys():
-        trip_location_hash_table[pickup_pixel] = deque()
-
     # Determine whether to request new vehicle or not
     request_new_vehicle, optimal_order = common_origin_validation(\
         trip_location_hash_table, trip_log, vehicles_log, new_trip_request, constraints)
@@ -384,7 +483,7 @@ def process_request(trip_log, trip, vehicles_log,
     if optimal_order is not None:
         pickup_pixel = new_trip_request.pickup_pixel
         new_first_trip_of_route = optimal_order[0][1]
-        scheduled_trip_from_this_origin = list(trip_location_hash_table[pickup_pixel])[-1][1]
+        scheduled_trip_from_this_origin = trip_location_hash_table.tail(pickup_pixel)
         pickup_time = scheduled_trip_from_this_origin.pickup_time
         if new_first_trip_of_route.pickup_request_time > pickup_time:
             request_new_vehicle = True
@@ -397,7 +496,8 @@ def process_request(trip_log, trip, vehicles_log,
                                    vehicles_log,
                                    constraints,
                                    trip_buffer,
-                                   trip_location_hash_table)
+                                   trip_location_hash_table,
+                                   fleet_index)
 
     # Enter RIDESHARE process
     # Greedy Heuristic
@@ -414,114 +514,164 @@ def process_request(trip_log, trip, vehicles_log,
 
 def handle_requests_at_this_time(trip_log, vehicles_log,
                                  requests, constraints,
-                                 trip_location_hash_table, trip_buffer, beliefs):
+                                 trip_location_hash_table, trip_buffer, beliefs,
+                                 fleet_index=None):
     '''Run the processes for all requests in this batch'''
     list_of_trip_requests_now = requests
-    for trip in list_of_trip_requests_now:
-        trip_log[trip.trip_id] = trip
-        trip_log, vehicles_log = process_request(trip_log,
-                                                 trip,
-                                                 vehicles_log,
-                                                 constraints,
-                                                 trip_location_hash_table,
-                                                 trip_buffer)
-        if int(constraints['freq_levrs']) != 0:
-            betas = {'initial' : constraints['initial_beta'], 'obs' : constraints['beta_obs']}
-            beliefs = demand_learning.update_belief_model(trip, beliefs, betas)
+    if constraints['batch_rideshare']:
+        for trip in list_of_trip_requests_now:
+            trip_log[trip.trip_id] = trip
+        trip_log, vehicles_log = match_requests_in_batch(trip_log,
+                                                         vehicles_log,
+                                                         list_of_trip_requests_now,
+                                                         constraints,
+                                                         trip_location_hash_table,
+                                                         trip_buffer,
+                                                         fleet_index)
+    else:
+        for trip in list_of_trip_requests_now:
+            trip_log[trip.trip_id] = trip
+            trip_log, vehicles_log = process_request(trip_log,
+                                                     trip,
+                                                     vehicles_log,
+                                                     constraints,
+                                                     trip_location_hash_table,
+                                                     trip_buffer,
+                                                     fleet_index)
+
+    # Beliefs are only read by LEVRS, so learn from the whole batch at once
+    if int(constraints['freq_levrs']) != 0:
+        betas = {'initial' : constraints['initial_beta'], 'obs' : constraints['beta_obs']}
+        beliefs = demand_learning.update_belief_model_tick(list_of_trip_requests_now,
+                                                           beliefs, betas)
 
     return trip_log, vehicles_log, beliefs
 
 def clear_trips_for_dispatch(trip_log, dispatch_time, vehicles_log,
                              trip_location_hash_table,
-                             trip_buffer, dict_writer):
-    '''Send dispatched files to output, remove from data structures'''
+                             trip_buffer, dict_writer, metrics):
+    '''Send dispatched files to output and metrics, remove from data structures'''
     if len(trip_buffer) < 1:
         return trip_location_hash_table, trip_buffer
 
-    while len(trip_buffer) > 0:
-        next_to_dispatch_trip, next_to_dispatch_pickup_time = trip_buffer[0]
-        if floor(next_to_dispatch_pickup_time) <= floor(dispatch_time):
-            pickup_pixel = next_to_dispatch_trip.pickup_pixel
-            vehicle_id = next_to_dispatch_trip.vehicle_id
-            vehicles_log[vehicle_id].cumulative_person_miles += \
-                trip_ops.get_person_miles_of_joined_trip(trip_log, next_to_dispatch_trip.trip_id)
-            vehicles_log[vehicle_id].cumulative_vehicle_miles += \
-                trip_ops.get_vehicle_miles_of_joined_trip(trip_log, next_to_dispatch_trip.trip_id)
-
-            all_joined_trips = trip_ops.get_all_joined_trips(trip_log, 
-                                                             next_to_dispatch_trip.trip_id)
-            for that_trip in all_joined_trips:
-                assert(that_trip.valid()), "Trip being written is invalid" # this needs to be true
-                dict_writer.writerow(that_trip.__dict__)
-                del trip_log[that_trip.trip_id]
-
-            trip_buffer.popleft()
-            trip_location_hash_table[pickup_pixel].popleft()
+    for next_to_dispatch_trip, _ in trip_buffer.pop_due(dispatch_time):
+        pickup_pixel = next_to_dispatch_trip.pickup_pixel
+        vehicle_id = next_to_dispatch_trip.vehicle_id
+        route = trip_ops.get_route(trip_log, next_to_dispatch_trip.trip_id)
+        vehicles_log[vehicle_id].cumulative_person_miles += route.person_miles
+        vehicles_log[vehicle_id].cumulative_vehicle_miles += route.vehicle_miles
 
-        else:
-            break
+        all_joined_trips = route.legs
+        for that_trip in all_joined_trips:
+            assert(not trip_ops.VALIDATE or that_trip.valid()), \
+                "Trip being written is invalid" # this needs to be true
+            dict_writer.writerow(that_trip.to_dict())
+            del trip_log[that_trip.trip_id]
+        metrics.add_joined_trip(all_joined_trips)
+
+        trip_location_hash_table.remove(pickup_pixel, next_to_dispatch_trip)
 
     return
 
-def receive_requests_now(reader, time, rollover_request):
-    '''Listen for requests at this time from the stream'''
-    if rollover_request is None:
-        requests_now = list()
-    else:
-        requests_now = [rollover_request]
-    while True:
-        try:
-            next_line = reader.next()
-            trip = trip_ops.process_cleaned_trip(next_line)
-            if trip.pickup_request_time > time:
-                return requests_now, trip
-            else:
-                requests_now.append(trip)
-        except StopIteration:
-            return None, None
+def test_clear_trips_for_dispatch():
+    '''Two routes from one origin leaving out of the order they were scheduled in:
+       the later one has the earlier pickup time, and only it is dispatched'''
+    from StringIO import StringIO
+    earlier = trip_ops.Trip(0, (0, 0), (3, 0), 10, 100, 100, 130, 1, 0)
+    later = trip_ops.Trip(1, (0, 0), (5, 0), 20, 100, 50, 90, 2, 0)
+    trip_log = dict((trip.trip_id, trip) for trip in (earlier, later))
+    vehicles_log = FleetState(2)
+    trip_location_hash_table = PendingRouteIndex()
+    trip_buffer = DispatchQueue()
+    for trip in (earlier, later):
+        trip_buffer.push(trip, trip.pickup_time)
+        trip_location_hash_table.append(trip.pickup_pixel, trip.dropoff_pixel, trip)
+    dict_writer = csv.DictWriter(StringIO(), trip_ops.TRIP_FIELDS)
+    metrics = MetricsAccumulator()
+    clear_trips_for_dispatch(trip_log, 60, vehicles_log, trip_location_hash_table,
+                             trip_buffer, dict_writer, metrics)
+    assert(trip_log.keys() == [0]), "Only the later route should be dispatched"
+    assert(trip_location_hash_table.head((0, 0)) is earlier), "Dispatched route left in the index"
+    assert(trip_location_hash_table.tail((0, 0)) is earlier), "Dispatched route left in the index"
+    assert(trip_location_hash_table.occupancy((0, 0)) == 1), "Occupancy of the remaining route"
+    clear_trips_for_dispatch(trip_log, 100, vehicles_log, trip_location_hash_table,
+                             trip_buffer, dict_writer, metrics)
+    assert(len(trip_log) == 0 and (0, 0) not in trip_location_hash_table), "Origin not cleared"
+    print metrics.number_of_trips
+
+def next_event_time(time, request_is_held, trip_buffer, freq_levrs):
+    '''Get the next time at which something can happen in the simulation'''
+    # TripStream.receive hands over a held over request on the very next tick
+    if request_is_held:
+        return time + 1
+
+    upcoming_events = list()
+
+    # Next dispatch deadline in the trip buffer
+    if len(trip_buffer) > 0:
+        next_to_dispatch_pickup_time = trip_buffer.peek()[1]
+        upcoming_events.append(int(floor(next_to_dispatch_pickup_time)))
+
+    # Next LEVRS boundary
+    if freq_levrs != 0:
+        upcoming_events.append((time // freq_levrs + 1) * freq_levrs)
+
+    if len(upcoming_events) == 0:
+        return time + 1
+    return max(time + 1, min(upcoming_events))
 
 def handle_all_trip_requests(constraints):
-    '''Main function'''
+    '''Main function, returns the vehicles log and the MetricsAccumulator of the run'''
     fleet_size = constraints['fleet_size']
-    beliefs = constraints['beliefs']
     local_demand_degree = constraints['local_demand_degree']
     freq_levrs = int(constraints['freq_levrs'])
 
+    # Priors are memory-mapped, not passed in: experiments that never learn share the
+    # page-cached file, learning experiments get private copy-on-write pages
+    if freq_levrs == 0:
+        beliefs = demand_learning.read_prior_file("r")
+    else:
+        beliefs = demand_learning.read_prior_file("c")
+
     cleaned_filepath = generic_ops.cleaned_fp(constraints['raw'])
     result_filepath = generic_ops.results_fp(constraints['raw'], constraints['index'])
 
     #-------------------------------------------------------- START READER OPS
-    inputfile = open(cleaned_filepath, 'rb')
-    reader = csv.DictReader(inputfile)
-    initial_trip_log = trip_ops.read_n_cleaned_trips(reader, fleet_size)
+    trip_stream = TripStore(cleaned_filepath).stream()
+    initial_trip_log = trip_ops.read_n_cleaned_trips(trip_stream, fleet_size)
     #-------------------------------------------------------- END READER OPS
 
 
     #-------------------------------------------------------- START WRITER OPS
     open(result_filepath, 'w').close() # reset the output file
     outputfile = open(result_filepath, 'wa')
-    keys = initial_trip_log.values()[0].__dict__.keys()
-    dict_writer = csv.DictWriter(outputfile, keys)
+    dict_writer = csv.DictWriter(outputfile, trip_ops.TRIP_FIELDS)
     dict_writer.writeheader()
+    metrics = MetricsAccumulator()
     for trip in initial_trip_log.values():
-        dict_writer.writerow(trip.__dict__)
+        dict_writer.writerow(trip.to_dict())
+        metrics.add_joined_trip([trip])
     #-------------------------------------------------------- END WRITER OPS
 
-    # trip_location_hash_table is a data structure that is a dict of trip origin points,
+    # trip_location_hash_table is a PendingRouteIndex of trip origin points,
     # each origin point contains a list of trips scheduled to leave from that point,
     # represented solely by the trip that is the first-stop of that trip
 
-    # trip_buffer is a double-queue data structure that enqueues requests as they come in
-    #   and dequeues them when they are dispatched.
+    # trip_buffer is a priority queue keyed on pickup time that enqueues requests as they
+    #   come in and dequeues them when they are dispatched.
 
     # trip_log is a dict that is synced with the trip_buffer,
     # contains more detailed info about trips
 
-    trip_location_hash_table = dict()
-    trip_buffer = deque()
+    trip_location_hash_table = PendingRouteIndex()
+    trip_buffer = DispatchQueue()
 
     # Transform Trip Log to Be Index By Vehicle ID
     vehicles_log = initial_vehicle_log(initial_trip_log, fleet_size)
+
+    # fleet_index buckets vehicles by pixel so the nearest one is found without a full scan,
+    # each vehicle keeps it up to date as its schedule changes
+    fleet_index = build_fleet_index(vehicles_log)
     # Get time of last initial pickup request
     start_time = initial_trip_log.values()[-1].pickup_request_time
 
@@ -530,16 +680,20 @@ def handle_all_trip_requests(constraints):
 
     trip_log = dict()
     time = start_time
-    rollover_request = None
+    stream_is_open = True
     while True:
-        requests, rollover_request = receive_requests_now(reader, time, rollover_request)
+        if stream_is_open:
+            requests = trip_stream.receive(time)
+            stream_is_open = requests is not None
+        else:
+            requests = None
 
         # There are no incoming trip requests or trips left to dispatch. End Loop
         if requests is None and len(trip_buffer) == 0:
             break
 
         # There are trip requests this turn. Process them.
-        if requests is not None and len(requests) >= 0:
+        if requests is not None:
             trip_log, vehicles_log, beliefs = \
                 handle_requests_at_this_time(trip_log,
                                              vehicles_log,
@@ -547,28 +701,34 @@ def handle_all_trip_requests(constraints):
                                              constraints,
                                              trip_location_hash_table,
                                              trip_buffer,
-                                             beliefs)
-        counter = 0
-        for pickup_pixel in trip_location_hash_table:
-            counter += len(trip_location_hash_table[pickup_pixel])
-
+                                             beliefs,
+                                             fleet_index)
         # Clear trips ready for dispatch at this time
         clear_trips_for_dispatch(trip_log,
+                                 time,
                                  vehicles_log,
-                                 constraints,
                                  trip_location_hash_table,
                                  trip_buffer,
-                                 dict_writer)
+                                 dict_writer,
+                                 metrics)
 
         # LEVRS Handling
         if freq_levrs != 0 and time % freq_levrs == 0:
             vehicles_log = \
                 handle_empty_repositioning(vehicles_log, time, beliefs, local_demand_degree)
 
-        time += 1 # next iteration of time
+        if metrics.sample_due(time):
+            metrics.sample(time, vehicles_log.idle_count(time), len(trip_buffer))
+
+        # Jump straight to the next request, dispatch deadline or LEVRS boundary,
+        # nothing happens on the seconds in between
+        time = next_event_time(time, trip_stream.holding, trip_buffer, freq_levrs)
 
     outputfile.close()
+    if beliefs.left_out > 0:
+        print "Did not learn from %s requests outside of the grid" % beliefs.left_out
+    metrics.save_npz(generic_ops.metrics_fp(constraints['raw'], constraints['index']))
 
     assert(len(trip_log) == 0), "There were %s undispatched trips." % (str(len(trip_log)))
 
-    return vehicles_log
+    return vehicles_log, metrics
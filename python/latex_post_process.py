@@ -6,29 +6,37 @@
         Create latex table from performance.py output
 """
 
-import csv
 from itertools import izip
 
+import performance
+
+# Row header of each performance.RESULT_COLUMNS column but the index
+HEADERS = {
+    'number_of_trips': "Number of Trip Requests",
+    'fleet_size': "Fleet Size",
+    'vehicle_size': "Maximum Vehicle Capacity",
+    'departure_delay': "Departure Delay User Tolerance",
+    'freq_levrs': "Frequency of Empty Repositioning",
+    'local_demand_degree': "Degree of Superpixel for Local Demand Survey",
+    'max_circuity': "Maximum Circuity of Ridesharing Trips",
+    'max_stops': "Maximum Number of Intermediate Ridesharing Stops",
+    'initial_beta': "Initial Precision Beta for Demand Learning",
+    'beta_obs': "Observation Precision Beta for Demand Learning",
+    'greedy_common_origin': "Greedy Common Origin Ridesharing",
+    'batch_rideshare': "Batch Common Origin Ridesharing",
+    'per_occupant_waiting_time': "Per Occupant Waiting Time",
+    'per_trip_repositioning_distance': "Per Trip \\newline Repositioning Distance",
+    'average_vehicle_occupancy': "Average Vehicle Occupancy (AVO)",
+    'average_trip_circuity': "Average Trip Circuity"}
+
 def create_latex_table(filename):
     '''Create the table.'''
-    headers = [
-        "Number of Trip Requests",
-        "Fleet Size",
-        "Maximum Vehicle Capacity",
-        "Departure Delay User Tolerance",
-        "Frequency of Empty Repositioning",
-        "Degree of Superpixel for Local Demand Survey",
-        "Maximum Circuity of Ridesharing Trips",
-        "Maximum Number of Intermediate Ridesharing Stops",
-        "Initial Precision Beta for Demand Learning",
-        "Observation Precision Beta for Demand Learning",
-        "Per Occupant Waiting Time",
-        "Per Trip \\newline Repositioning Distance",
-        "Average Vehicle Occupancy (AVO)",
-        "Average Trip Circuity"]
-
-    data = izip(*csv.reader(open(filename, "r")))
-    num_experiments = len(list(csv.reader(open(filename, "r"))))
+    # One column per experiment, in index order, one row per result column
+    columns = performance.RESULT_COLUMNS[1:]
+    headers = [HEADERS[column] for column in columns]
+    records = performance.read_results(filename)
+    data = izip(*[[record[column] for column in columns] for record in records])
+    num_experiments = len(records)
 
     latex_pre = """\\begin{tabularx}{8.25in}"""
     latex_post = "\\end{tabularx}"
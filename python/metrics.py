@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+    File: metrics.py
+    Author: Keith Gladstone
+    Description:
+        Running performance metrics of a simulation
+    Notes:
+        The handler adds every trip as it is written to the results file,
+        so performance_report does not read the results back. Memory is
+        a handful of running sums, whatever the number of trips
+        Per occupant waiting time and circuity also go into fixed-bin
+        histograms, and into a TimeSeries of buckets by request time.
+        The handler samples the idle fleet and the trip buffer depth
+        into the same TimeSeries at the first event of each bucket, as
+        counting the idle fleet is O(V). save_npz writes it all as one
+        compressed file per experiment
+"""
+import numpy as np
+
+import trip_ops
+
+WAITING_TIME_BIN_SECONDS = 15
+WAITING_TIME_BINS = 240       # up to an hour, the last bin takes anything longer
+CIRCUITY_BIN_WIDTH = 0.05
+CIRCUITY_BINS = 40            # from 1 up to 3, the last bin takes anything longer
+BUCKET_SECONDS = 60
+
+TIMELINE_COLUMNS = ('occupants',
+                    'occupant_waiting_time',
+                    'circuity_occupants',
+                    'occupant_circuity',
+                    'samples',
+                    'idle_vehicles',
+                    'buffer_depth')
+
+class Histogram(object):
+    '''Weights of values in fixed width bins from lowest, out of range values
+       go to the first or last bin'''
+    __slots__ = ('lowest', 'bin_width', 'counts')
+
+    def __init__(self, lowest, bin_width, bins):
+        self.lowest = lowest
+        self.bin_width = bin_width
+        self.counts = np.zeros(bins)
+
+    def add(self, value, weight=1):
+        index = int((value - self.lowest) / self.bin_width)
+        self.counts[min(max(index, 0), len(self.counts) - 1)] += weight
+        return self
+
+    def edges(self):
+        return self.lowest + self.bin_width * np.arange(len(self.counts) + 1)
+
+class TimeSeries(object):
+    '''Sums of named columns per bucket of bucket_seconds, from the bucket of the
+       first time added. The columns double in length as time goes on.'''
+    __slots__ = ('bucket_seconds', 'start_time', 'length', 'columns')
+
+    def __init__(self, names, bucket_seconds=BUCKET_SECONDS):
+        self.bucket_seconds = bucket_seconds
+        self.start_time = None
+        self.length = 0
+        self.columns = dict((name, np.zeros(0)) for name in names)
+
+    def bucket(self, time):
+        '''Index of the bucket of time, making room for it'''
+        if self.start_time is None:
+            self.start_time = (int(time) // self.bucket_seconds) * self.bucket_seconds
+        index = max(int(time - self.start_time) // self.bucket_seconds, 0)
+        if index >= self.length:
+            self.length = index + 1
+            size = len(self.columns.itervalues().next())
+            if self.length > size:
+                size = max(self.length, 2 * size, 64)
+                for name, column in self.columns.items():
+                    grown = np.zeros(size)
+                    grown[:len(column)] = column
+                    self.columns[name] = grown
+        return index
+
+    def arrays(self):
+        '''Columns trimmed to the buckets in use'''
+        return dict((name, column[:self.length]) for name, column in self.columns.items())
+
+class MetricsAccumulator(object):
+    '''Running sums over the written trips'''
+    __slots__ = ('number_of_trips',
+                 'occupants',
+                 'occupant_waiting_time',
+                 'circuity_occupants',
+                 'occupant_circuity',
+                 'waiting_time_histogram',
+                 'circuity_histogram',
+                 'timeline',
+                 'sampled_bucket')
+
+    def __init__(self, bucket_seconds=BUCKET_SECONDS):
+        self.number_of_trips = 0
+        self.occupants = 0
+        self.occupant_waiting_time = 0.0
+        self.circuity_occupants = 0
+        self.occupant_circuity = 0.0
+        self.waiting_time_histogram = Histogram(0, WAITING_TIME_BIN_SECONDS, WAITING_TIME_BINS)
+        self.circuity_histogram = Histogram(1.0, CIRCUITY_BIN_WIDTH, CIRCUITY_BINS)
+        self.timeline = TimeSeries(TIMELINE_COLUMNS, bucket_seconds)
+        self.sampled_bucket = None
+
+    def add_joined_trip(self, legs):
+        '''Add the legs of a joined trip, in dropoff order.
+           Leg circuities are those of trip_ops.get_leg_circuities.'''
+        columns = self.timeline.columns
+        for leg in legs:
+            bucket = self.timeline.bucket(leg.pickup_request_time)
+            self.number_of_trips += 1
+            self.occupants += leg.occupancy
+            # Whole seconds, as the waiting times read back from the results file were
+            waiting_time = float(int(leg.pickup_time)) - float(leg.pickup_request_time)
+            self.occupant_waiting_time += leg.occupancy * waiting_time
+            self.waiting_time_histogram.add(waiting_time, leg.occupancy)
+            columns['occupants'][bucket] += leg.occupancy
+            columns['occupant_waiting_time'][bucket] += leg.occupancy * waiting_time
+        for leg, circuity in trip_ops.get_leg_circuities(legs):
+            bucket = self.timeline.bucket(leg.pickup_request_time)
+            self.circuity_occupants += leg.occupancy
+            self.occupant_circuity += leg.occupancy * circuity
+            self.circuity_histogram.add(circuity, leg.occupancy)
+            columns['circuity_occupants'][bucket] += leg.occupancy
+            columns['occupant_circuity'][bucket] += leg.occupancy * circuity
+        return self
+
+    def sample_due(self, time):
+        '''Whether the bucket of time has not been sampled yet'''
+        return self.timeline.bucket(time) != self.sampled_bucket
+
+    def sample(self, time, idle_vehicles, buffer_depth):
+        '''Record the idle fleet and trip buffer depth at time'''
+        bucket = self.timeline.bucket(time)
+        self.sampled_bucket = bucket
+        columns = self.timeline.columns
+        columns['samples'][bucket] += 1
+        columns['idle_vehicles'][bucket] += idle_vehicles
+        columns['buffer_depth'][bucket] += buffer_depth
+        return self
+
+    def per_occupant_waiting_time(self):
+        return self.occupant_waiting_time / self.occupants
+
+    def per_occupant_circuity(self):
+        if self.circuity_occupants == 0:
+            return 1.0
+        return self.occupant_circuity / self.circuity_occupants
+
+    def save_npz(self, filename):
+        '''Write the histograms and the timeline. Per bucket averages are the
+           occupant_* columns over their *occupants column, and idle_vehicles and
+           buffer_depth over samples.'''
+        arrays = self.timeline.arrays()
+        np.savez_compressed(filename,
+                            bucket_seconds=self.timeline.bucket_seconds,
+                            start_time=-1 if self.timeline.start_time is None \
+                                       else self.timeline.start_time,
+                            waiting_time_counts=self.waiting_time_histogram.counts,
+                            waiting_time_edges=self.waiting_time_histogram.edges(),
+                            circuity_counts=self.circuity_histogram.counts,
+                            circuity_edges=self.circuity_histogram.edges(),
+                            **arrays)
+        return
@@ -8,49 +8,47 @@
 import time
 from pathlib import Path
 import os
-from multiprocessing import Pool
-import csv
-import operator
 
 import clean_trip_schedule
 import performance
 import handler
 import generic_ops
 import demand_learning
+import trip_store
 import latex_post_process
+import sweep
 
 # Run experiment
 def run_experiment(arg_dict):
     print "Running Experiment #%s" % (str(arg_dict['index']))
     print "Fleet Size: %s" % (str(arg_dict['fleet_size']))
     try:
-        vehicles_log = handler.handle_all_trip_requests(arg_dict)
+        vehicles_log, metrics = handler.handle_all_trip_requests(arg_dict)
         print "Finished Experiment #%s" % (str(arg_dict['index']))
-        performance.performance_report(vehicles_log, arg_dict)
+        record = performance.performance_report(vehicles_log, metrics, arg_dict)
         print "Finished Performance Analysis #%s" % (str(arg_dict['index']))
+        return record
 
     except:
         print "It broke..."
-        my_list = list()
-        for key, item in arg_dict.iteritems():
-            if key != 'priors':
-                my_list.append((key, item))
-        print my_list
+        print arg_dict.items()
         raise
 
-def main(raw_data_file_name):
+def main(raw_data_file_name, outfile_name=None):
+    '''Run the sweep, pass the out file of an interrupted sweep to resume it'''
     cleaned_filepath = generic_ops.cleaned_fp(raw_data_file_name)
 
     assert raw_data_file_name != "", "Must be a raw data file"
 
-    time_series = time.asctime().replace(" ", "").replace(":", "")
-    outfile_name = "out/out-" + raw_data_file_name + "-" + time_series + ".csv"
+    if outfile_name is None:
+        time_series = time.asctime().replace(" ", "").replace(":", "")
+        outfile_name = "out/out-" + raw_data_file_name + "-" + time_series + ".csv"
 
-    # Reset the out file
-    try:
-        os.remove(outfile_name)
-    except OSError:
-        pass
+        # Reset the out file
+        try:
+            os.remove(outfile_name)
+        except OSError:
+            pass
 
     print "=========================================="
     print "Running trip schedule script"
@@ -84,65 +82,38 @@ def main(raw_data_file_name):
     # Irrelevant until Round D
     local_demand_degree_list = [20]
     greedy_common_origin_list = [True]
+    batch_rideshare_list = [False]
     initial_beta_list = [10]
     beta_obs_list = [1]
     freq_levrs_list = [0]
 
-    prior_demand_beliefs = demand_learning.read_prior_file()
-
-    list_of_arg_dicts = list()
-    index = 0
-    for departure_delay in departure_delay_list:
-        for fleet_size in fleet_size_list:
-            for max_circuity in max_circuity_list:
-                for vehicle_size in vehicle_size_list:
-                    for max_stops in max_stops_list:
-                        for local_demand_degree in local_demand_degree_list:
-                            for greedy_common_origin in greedy_common_origin_list:
-                                for initial_beta in initial_beta_list:
-                                    for beta_obs in beta_obs_list:
-                                        for freq_levrs in freq_levrs_list:
-                                            list_of_arg_dicts.append({\
-                                                'index' : index, \
-                                                'raw' : raw_data_file_name, \
-                                                'outfile_name': outfile_name, \
-                                                'priors' : prior_demand_beliefs, \
-                                                'initial_beta' : initial_beta, \
-                                                'beta_obs' : beta_obs, \
-                                                'local_demand_degree': local_demand_degree, \
-                                                'greedy_common_origin': greedy_common_origin, \
-                                                'max_circuity' : max_circuity, \
-                                                'max_stops' : max_stops, \
-                                                'fleet_size': fleet_size, \
-                                                'vehicle_size': vehicle_size, \
-                                                'freq_levrs': freq_levrs, \
-                                                'departure_delay': departure_delay})
-                                            index += 1
+    # Workers memory-map the binary priors and trips themselves, make sure they exist
+    demand_learning.convert_prior_file()
+    trip_store.convert_cleaned_trips(cleaned_filepath)
+
+    list_of_arg_dicts = sweep.make_sweep(raw_data_file_name, {\
+        'departure_delay': departure_delay_list, \
+        'fleet_size': fleet_size_list, \
+        'max_circuity': max_circuity_list, \
+        'vehicle_size': vehicle_size_list, \
+        'max_stops': max_stops_list, \
+        'local_demand_degree': local_demand_degree_list, \
+        'greedy_common_origin': greedy_common_origin_list, \
+        'batch_rideshare': batch_rideshare_list, \
+        'initial_beta': initial_beta_list, \
+        'beta_obs': beta_obs_list, \
+        'freq_levrs': freq_levrs_list})
 
     # Configure pooling [on/off]
     do_pool = False
     do_pool = True
 
-    print "Running %s experiments..." % (len(list_of_arg_dicts))
-
-    # Parallel
-    if do_pool:
-        print "In Parallel"
-        pool = Pool()
-        pool.map(run_experiment, list_of_arg_dicts)
-
-    # Series
-    else:
-        print "In Series"
-        for i in list_of_arg_dicts:
-            run_experiment(i)
+    sweep.run_sweep(run_experiment, list_of_arg_dicts, cleaned_filepath, outfile_name, do_pool)
 
     # Print results
-    data = csv.reader(open(outfile_name), delimiter=',')
-    sortedlist = sorted(data, key=operator.itemgetter(0, 1, 2, 3, 4))
     print "----------\nExperiment Results: "
-    for row in sortedlist:
-        print row
+    for record in performance.read_results(outfile_name):
+        print [record[column] for column in performance.RESULT_COLUMNS]
 
     # Latex post-processing
     print "----------\nLatex Table:"
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+    File: pending_routes.py
+    Author: Keith Gladstone
+
+    Description:
+        Index of the routes waiting for dispatch, by origin pixel.
+        Replaces the dict of deques of (dropoff_pixel, trip) tuples
+        that backed the trip_location_hash_table.
+    Notes:
+        Each origin keeps its routes in the order they were scheduled,
+        represented by their first leg, plus the running sum of those
+        first legs' occupancy, which is what common origin validation
+        compares against the vehicle size.
+        Routes at one origin can be dispatched out of the order they were
+        scheduled in, a later request may get a closer vehicle, so routes
+        are removed by their first leg, not from the front.
+        An origin is dropped as soon as its last route is.
+"""
+from collections import deque
+from itertools import islice
+
+class PendingRouteIndex(object):
+    '''Undispatched routes per origin pixel, head and tail in O(1)'''
+    def __init__(self):
+        self.routes = dict()    # pickup pixel -> deque of (dropoff_pixel, first leg)
+        self.occupants = dict() # pickup pixel -> occupancy of the first legs
+
+    def __contains__(self, pickup_pixel):
+        return pickup_pixel in self.routes
+
+    def __len__(self):
+        return len(self.routes)
+
+    def count(self, pickup_pixel):
+        '''Number of routes waiting at pickup_pixel'''
+        routes = self.routes.get(pickup_pixel)
+        return 0 if routes is None else len(routes)
+
+    def head(self, pickup_pixel):
+        '''First leg of the earliest route scheduled at pickup_pixel'''
+        return self.routes[pickup_pixel][0][1]
+
+    def tail(self, pickup_pixel):
+        '''First leg of the latest route scheduled at pickup_pixel'''
+        return self.routes[pickup_pixel][-1][1]
+
+    def latest(self, pickup_pixel, limit):
+        '''First legs of up to limit routes scheduled last at pickup_pixel, latest first'''
+        routes = self.routes.get(pickup_pixel)
+        if routes is None:
+            return list()
+        return [trip for _, trip in islice(reversed(routes), limit)]
+
+    def occupancy(self, pickup_pixel):
+        '''Sum of the first legs' occupancy at pickup_pixel'''
+        return self.occupants.get(pickup_pixel, 0)
+
+    def append(self, pickup_pixel, dropoff_pixel, trip):
+        '''Schedule a route at pickup_pixel, trip is its first leg. O(1)'''
+        if pickup_pixel not in self.routes:
+            self.routes[pickup_pixel] = deque()
+            self.occupants[pickup_pixel] = 0
+        self.routes[pickup_pixel].append((dropoff_pixel, trip))
+        self.occupants[pickup_pixel] += trip.occupancy
+        return self
+
+    def replace(self, pickup_pixel, old_trip, dropoff_pixel, new_trip):
+        '''Put the route with first leg new_trip in the place of old_trip's. O(routes)'''
+        routes = self.routes[pickup_pixel]
+        for position, (_, trip) in enumerate(routes):
+            if trip is old_trip:
+                routes[position] = (dropoff_pixel, new_trip)
+                self.occupants[pickup_pixel] += new_trip.occupancy - old_trip.occupancy
+                return self
+        raise KeyError(old_trip.trip_id)
+
+    def remove(self, pickup_pixel, trip):
+        '''Drop the route with first leg trip, wherever it is in line. O(routes)'''
+        routes = self.routes[pickup_pixel]
+        for position, (_, scheduled_trip) in enumerate(routes):
+            if scheduled_trip is trip:
+                del routes[position]
+                if len(routes) == 0:
+                    del self.routes[pickup_pixel]
+                    del self.occupants[pickup_pixel]
+                else:
+                    self.occupants[pickup_pixel] -= trip.occupancy
+                return trip
+        raise KeyError(trip.trip_id)
+
+def test_replace():
+    '''Test "PendingRouteIndex.replace"'''
+    from trip_ops import Trip
+    first = Trip(1, (0, 0), (3, 0), 10, 100, 70, 100, 1, 0)
+    second = Trip(2, (0, 0), (5, 0), 10, 100, 70, 100, 2, 0)
+    joined = Trip(3, (0, 0), (1, 0), 10, 100, 70, 100, 1, 0)
+    index = PendingRouteIndex().append((0, 0), (3, 0), first).append((0, 0), (5, 0), second)
+    index.replace((0, 0), first, (1, 0), joined)
+    assert(index.head((0, 0)) is joined), "Replaced route should keep its place"
+    assert(index.tail((0, 0)) is second), "Other routes should not move"
+    assert(index.routes[(0, 0)][0][0] == (1, 0)), "Dropoff pixel not replaced"
+    assert(index.occupancy((0, 0)) == 3), "Occupancy should follow the first legs"
+    try:
+        index.replace((0, 0), first, (3, 0), first)
+        assert False, "Replacing a route that is not pending should fail"
+    except KeyError:
+        pass
+    print [trip.trip_id for trip in index.latest((0, 0), 2)]
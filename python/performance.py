@@ -4,131 +4,96 @@
     Author: Keith Gladstone
     Description:
         Report the performance of the simulations
+    Notes:
+        performance_report turns the vehicles log and the metrics.py
+        running sums of a run into one record per experiment, keyed by
+        RESULT_COLUMNS. Workers hand their records back to the sweep, the
+        only process that writes them to the out file, so rows never
+        interleave and can arrive in any order
 """
 import csv
+import os
 import numpy as np
-import pixel_ops
-import trip_ops
-import generic_ops
 
-# O(V)
+RESULT_COLUMNS = ('index',
+                  'number_of_trips',
+                  'fleet_size',
+                  'vehicle_size',
+                  'departure_delay',
+                  'freq_levrs',
+                  'local_demand_degree',
+                  'max_circuity',
+                  'max_stops',
+                  'initial_beta',
+                  'beta_obs',
+                  'greedy_common_origin',
+                  'batch_rideshare',
+                  'per_occupant_waiting_time',
+                  'per_trip_repositioning_distance',
+                  'average_vehicle_occupancy',
+                  'average_trip_circuity')
+
+# O(V), each vehicle's distance is truncated before summing
 def total_repositioning_distance_of_fleet(vehicles_log):
-    total = 0
-    for vehicle_id in vehicles_log:
-        total += int(vehicles_log[vehicle_id].cumulative_reposition_distance)
-    return total
-
-def waiting_time(trip):
-    return float(trip.pickup_time) - float(trip.pickup_request_time)
-
-# O(T)
-def cumulative_sum_of_stat(trip_log, stat):
-    return np.sum([stat(trip) for trip in trip_log.values()])
-
-# O(T)
-def per_occupant_average_of_stat(trip_log, stat):
-    return np.average([stat(trip) for trip in trip_log.values()], \
-        weights=[trip.occupancy for trip in trip_log.values()])
-
-# Full of holes?
-def time_vector_per_occupant_sum_of_stat(trip_log, stat):
-    max_time = max([trip.pickup_request_time for trip in trip_log.values()]) / 60
-    min_time = min([trip.pickup_request_time for trip in trip_log.values()]) / 60
-
-    time_schedule = [(0, 0)] * (max_time - min_time + 1)
-    for trip in trip_log.values():
-        time_slot = (trip.pickup_request_time / 60) - min_time
-        current_x1, current_x2 = time_schedule[time_slot]
-        time_schedule[time_slot] = (trip.occupancy * stat(trip) + current_x1,
-                                    trip.occupancy + current_x2)
-    return time_schedule
-
-# O(T)
-def get_per_occupant_waiting_time(trip_log):
-    return per_occupant_average_of_stat(trip_log, waiting_time)
-
-# Per occupant waiting time, over time
-def vector_per_occupant_waiting_time(trip_log):
-    return time_vector_per_occupant_sum_of_stat(trip_log, waiting_time)
-
-# O(T)
-def get_cumulative_waiting_time(trip_log):
-    return cumulative_sum_of_stat(trip_log, waiting_time)
-
-def get_number_of_trips(trip_log):
-    return len(trip_log)
-
-def distance_of_trip(trip):
-    if type(trip.pickup_pixel).__name__ == "str":
-        pickup_pixel = trip_ops.parse_pair_with_paren(trip.pickup_pixel)
-        dropoff_pixel = trip_ops.parse_pair_with_paren(trip.dropoff_pixel)
-    else:
-        pickup_pixel = trip.pickup_pixel
-        dropoff_pixel = trip.dropoff_pixel
-    return float(pixel_ops.manhattan_distance(pickup_pixel, dropoff_pixel))
-
-# O(T)
-def get_cumulative_distance(trip_log):
-    return cumulative_sum_of_stat(trip_log, distance_of_trip)
-
+    return int(np.sum(vehicles_log.cumulative_reposition_distance.astype(int)))
 
 def get_person_miles_from_vehicle_log(vehicles_log):
-    person_miles = 0.0
-    for vehicle_id in vehicles_log:
-        person_miles += vehicles_log[vehicle_id].cumulative_person_miles
-    return person_miles
+    return float(np.sum(vehicles_log.cumulative_person_miles))
 
 # Does include repositioning vehicle miles
 def get_vehicle_miles_from_vehicle_log(vehicles_log):
-    vehicle_miles = 0.0
-    for vehicle_id in vehicles_log:
-        vehicle_miles += vehicles_log[vehicle_id].cumulative_vehicle_miles
-        vehicle_miles += vehicles_log[vehicle_id].cumulative_reposition_distance
-    return vehicle_miles
+    return float(np.sum(vehicles_log.cumulative_vehicle_miles) +
+                 np.sum(vehicles_log.cumulative_reposition_distance))
 
-def performance_report(vehicles_log, arg_dict):
-    filename = arg_dict['fn']
-    fleet_size = arg_dict['fleet_size']
-    vehicle_size = arg_dict['vehicle_size']
-    departure_delay = arg_dict['departure_delay']
-    max_circuity = arg_dict['max_circuity']
-    max_stops = arg_dict['max_stops']
-    local_demand_degree = arg_dict['local_demand_degree']
-    initial_beta = arg_dict['initial_beta']
-    beta_obs = arg_dict['beta_obs']
-    freq_levrs = arg_dict['freq_levrs']
-
-    results_filename = generic_ops.results_fp(arg_dict['raw'], arg_dict['index'])
-    trip_log = trip_ops.get_results_trip_log(results_filename)
-
-    number_of_trips = get_number_of_trips(trip_log)
+def performance_report(vehicles_log, metrics, arg_dict):
+    '''Performance record of one experiment, keyed by RESULT_COLUMNS'''
+    number_of_trips = metrics.number_of_trips
     repositioning_distance = total_repositioning_distance_of_fleet(vehicles_log)
     per_trip_repositioning_distance = 1.0 * repositioning_distance / number_of_trips
-    per_occupant_waiting_time = get_per_occupant_waiting_time(trip_log)
+    per_occupant_waiting_time = metrics.per_occupant_waiting_time()
+    average_trip_circuity = metrics.per_occupant_circuity()
     total_vehicle_miles = get_vehicle_miles_from_vehicle_log(vehicles_log)
     total_person_miles = get_person_miles_from_vehicle_log(vehicles_log)
     average_vehicle_occupancy = total_person_miles / total_vehicle_miles
 
-    csv_report = [number_of_trips, \
-                fleet_size, \
-                vehicle_size, \
-                departure_delay, \
-                freq_levrs, \
-                local_demand_degree, \
-                max_circuity, \
-                max_stops, \
-                initial_beta, \
-                beta_obs, \
-                round(per_occupant_waiting_time, 3), \
-                round(per_trip_repositioning_distance, 3), \
-                round(average_vehicle_occupancy, 3), \
-                ]
-
-    # Save
+    return {'index': arg_dict['index'],
+            'number_of_trips': number_of_trips,
+            'fleet_size': arg_dict['fleet_size'],
+            'vehicle_size': arg_dict['vehicle_size'],
+            'departure_delay': arg_dict['departure_delay'],
+            'freq_levrs': arg_dict['freq_levrs'],
+            'local_demand_degree': arg_dict['local_demand_degree'],
+            'max_circuity': arg_dict['max_circuity'],
+            'max_stops': arg_dict['max_stops'],
+            'initial_beta': arg_dict['initial_beta'],
+            'beta_obs': arg_dict['beta_obs'],
+            'greedy_common_origin': int(arg_dict['greedy_common_origin']),
+            'batch_rideshare': int(arg_dict['batch_rideshare']),
+            'per_occupant_waiting_time': round(per_occupant_waiting_time, 3),
+            'per_trip_repositioning_distance': round(per_trip_repositioning_distance, 3),
+            'average_vehicle_occupancy': round(average_vehicle_occupancy, 3),
+            'average_trip_circuity': round(average_trip_circuity, 3)}
+
+def write_results(filename, records):
+    '''Append records to the out file, with a header row if it is new.
+       Only one process may write a given out file.'''
+    is_new = not os.path.isfile(filename) or os.path.getsize(filename) == 0
     with open(filename, "a") as csvfile:
-        csvwriter = csv.writer(csvfile,
-                               delimiter=',',
-                               quotechar='|',
-                               quoting=csv.QUOTE_MINIMAL)
-        csvwriter.writerow(csv_report)
+        csvwriter = csv.DictWriter(csvfile,
+                                   RESULT_COLUMNS,
+                                   delimiter=',',
+                                   quotechar='|',
+                                   quoting=csv.QUOTE_MINIMAL)
+        if is_new:
+            csvwriter.writeheader()
+        for record in records:
+            csvwriter.writerow(record)
     return
+
+def read_results(filename):
+    '''Records of the out file, in experiment index order'''
+    if not os.path.isfile(filename):
+        return list()
+    with open(filename, "r") as csvfile:
+        records = list(csv.DictReader(csvfile, delimiter=',', quotechar='|'))
+    return sorted(records, key=lambda record: int(record['index']))
@@ -6,12 +6,22 @@
         Lower level pixel-related operations
 """
 import sys
+import random
+import time
+
+import numpy as np
+
+LATITUDE_SHIFT = -40.54
+LONGITUDE_SHIFT = 74.356
+PIXEL_SCALE = 200
+
+# Pixel grid of the NYC cutoff in clean_trip_schedule, every cleaned trip is inside it
+GRID_X_SIZE = 106 # up to longitude -73.829498
+GRID_Y_SIZE = 77  # up to latitude 40.92
 
 def latitude_to_y_coord(lat_coord):
     '''Map latitude coordinate to pixel y-coordinate'''
-    shift = -40.54
-    scale = 200
-    y_coord = int((lat_coord + shift) * scale)
+    y_coord = int((lat_coord + LATITUDE_SHIFT) * PIXEL_SCALE)
     if y_coord < 0:
         print lat_coord
         assert(False), "y is negative"
@@ -19,14 +29,26 @@ def latitude_to_y_coord(lat_coord):
 
 def longitude_to_x_coord(long_coord):
     '''Map longitude coordinate to pixel x-coordinate'''
-    shift = 74.356
-    scale = 200
-    x_coord = int((long_coord + shift) * scale)
+    x_coord = int((long_coord + LONGITUDE_SHIFT) * PIXEL_SCALE)
     if x_coord < 0:
         print long_coord
         assert(False), "x is negative"
     return x_coord
 
+def pixelate_arrays(longitudes, latitudes):
+    '''Vectorized longitude_to_x_coord and latitude_to_y_coord over arrays'''
+    # astype(int) truncates toward zero like int()
+    x_coords = ((longitudes + LONGITUDE_SHIFT) * PIXEL_SCALE).astype(int)
+    y_coords = ((latitudes + LATITUDE_SHIFT) * PIXEL_SCALE).astype(int)
+    assert(not (x_coords < 0).any()), "x is negative"
+    assert(not (y_coords < 0).any()), "y is negative"
+    return x_coords, y_coords
+
+def in_grid(x_coords, y_coords):
+    '''Whether pixels are inside the grid, for coordinates or arrays of them'''
+    return (0 <= x_coords) & (x_coords < GRID_X_SIZE) & \
+           (0 <= y_coords) & (y_coords < GRID_Y_SIZE)
+
 def pixelate_pair(point):
     '''Pixelate a pair of lng, lat'''
     lng, lat = point
@@ -91,9 +113,10 @@ def manhattan_distance(p1, p2):
     x2, y2 = p2
     return int(abs(x1 - x2)) + int(abs(y1 - y2))
 
+MANHATTAN_SPEED = 0.57053355301967001 # from analysis
+
 def time_of_travel(p1, p2):
     dist = manhattan_distance(p1, p2)
-    MANHATTAN_SPEED = 0.57053355301967001 # from analysis
     return dist/MANHATTAN_SPEED
 
 def copy_of_list_without_item(l, i):
@@ -135,22 +158,98 @@ def get_shortest_path_from_tree(tree):
         t = (min_distance, [root] + champion_path)
     return t
 
-def hamilton(origin, destination_list):
+def hamilton_tree(origin, destination_list):
+    '''Shortest path through every destination, by walking the full permutation tree'''
     t = construct_path_tree(origin, destination_list)
     return get_shortest_path_from_tree(t)
 
+def hamilton(origin, destination_list):
+    '''Shortest path through every destination, by Held-Karp over subsets.
+       Same distance, path and tie-break as hamilton_tree: among equally short
+       paths, the one that visits destinations earliest in the list wins.'''
+    n = len(destination_list)
+    if n == 0:
+        return (0, [])
+    pixels = [destination[0] for destination in destination_list]
+    distance = [[manhattan_distance(p, q) for q in pixels] for p in pixels]
+    full = (1 << n) - 1
+
+    # remaining[mask][j] is the shortest way to visit every destination not in mask,
+    # starting from destination j, where mask holds the ones already visited
+    remaining = [[0] * n for _ in xrange(1 << n)]
+    for mask in xrange(full - 1, 0, -1):
+        unvisited = [k for k in xrange(n) if not mask & (1 << k)]
+        for j in xrange(n):
+            if mask & (1 << j):
+                remaining[mask][j] = min(distance[j][k] + remaining[mask | (1 << k)][k]
+                                         for k in unvisited)
+
+    # Walk forward, taking the first destination that stays on a shortest path
+    path = [origin]
+    total = None
+    mask = 0
+    current = None
+    while mask != full:
+        champion = None
+        min_distance = sys.maxint
+        for k in xrange(n):
+            if mask & (1 << k):
+                continue
+            if current is None:
+                step = manhattan_distance(origin[0], pixels[k])
+            else:
+                step = distance[current][k]
+            if step + remaining[mask | (1 << k)][k] < min_distance:
+                min_distance = step + remaining[mask | (1 << k)][k]
+                champion = k
+        if total is None:
+            total = min_distance
+        mask |= 1 << champion
+        current = champion
+        path.append(destination_list[champion])
+    return (total, path)
+
 def hamilton_of_trip_list(trip_list):
-    origin = (trip_list[0].oP, trip_list[0])
-    destination_list = [(trip.dP, trip) for trip in trip_list]
+    origin = (trip_list[0].pickup_pixel, trip_list[0])
+    destination_list = [(trip.dropoff_pixel, trip) for trip in trip_list]
     return hamilton(origin, destination_list)
 
 def test_hamilton():
-    origin = (1, 1)
+    origin = ((1, 1), "o")
     destination_list = [\
-      (5, 5),\
-      (60, 10),\
-      (2, 2),\
+      ((5, 5), "a"),\
+      ((60, 10), "b"),\
+      ((2, 2), "c"),\
     ]
     result = hamilton(origin, destination_list)
-    assert(str(result) == "(68, [(1, 1), (2, 2), (5, 5), (60, 10)])"), "Violates hamilton test"
+    assert(str(result) == \
+        "(68, [((1, 1), 'o'), ((2, 2), 'c'), ((5, 5), 'a'), ((60, 10), 'b')])"), \
+        "Violates hamilton test"
+    assert(result == hamilton_tree(origin, destination_list)), "Held-Karp differs from tree"
     print result
+
+def benchmark_hamilton(min_legs=2, max_legs=10, max_tree_legs=8, trials=5):
+    '''Time Held-Karp against the permutation tree for min_legs..max_legs legs.
+       The tree is factorial in time and memory, so it is skipped past max_tree_legs.'''
+    generator = random.Random(0)
+    print "legs, held-karp seconds, tree seconds"
+    for legs in range(min_legs, max_legs + 1):
+        dp_seconds = 0.0
+        tree_seconds = 0.0
+        for _ in range(trials):
+            # Few distinct pixels, so equal-length paths (ties) come up often
+            destination_list = [((generator.randint(0, 6), generator.randint(0, 6)), k) \
+                                for k in range(legs)]
+            origin = destination_list[0]
+            start = time.time()
+            result = hamilton(origin, destination_list)
+            dp_seconds += time.time() - start
+            if legs <= max_tree_legs:
+                start = time.time()
+                tree_result = hamilton_tree(origin, destination_list)
+                tree_seconds += time.time() - start
+                assert(result == tree_result), "Held-Karp differs from tree"
+        if legs <= max_tree_legs:
+            print "%s, %.6f, %.6f" % (legs, dp_seconds / trials, tree_seconds / trials)
+        else:
+            print "%s, %.6f, skipped" % (legs, dp_seconds / trials)
@@ -10,7 +10,6 @@ from pathlib import Path
 
 import demand
 import demand_plot
-import trip_ops
 import clean_trip_schedule
 from generic_ops import cleaned_fp
 
@@ -32,19 +31,14 @@ if my_file.is_file() is False:
 else:
     print "Cleaned file exists already. Moving on..."
 
-# Prereq: load the trip data
-print "Loading Trip Log for " + root_file
-trip_log = trip_ops.get_trip_log(root_file)
-print "Finished Loading Trip Log (size: " + str(len(trip_log)) + ")"
-
 # # Generate the demand data
-d, x_max = demand.citywide_demand_per_minute(trip_log, root_file, MINUTES_IN_DAY)
+d, x_max = demand.citywide_demand_per_minute(root_file, MINUTES_IN_DAY)
 title = "NYC Yellow Cab Vehicle Occupancy on 1/13/16"
 print "Citywide Demand Grid Created for " + root_file
 
 # Sample Usages
 # Generate the demand data for a week
-# d, x_max = demand.citywide_demand_per_minute(trip_log, root_file, int(MINUTES_IN_DAY*5.1))
+# d, x_max = demand.citywide_demand_per_minute(root_file, int(MINUTES_IN_DAY*5.1))
 # title = "NYC Yellow Cab Vehicle Occupancy Over Five Day Span"
 # print "Citywide Demand Grid Created for " + root_file
 
@@ -54,26 +48,26 @@ print "Citywide Demand Grid Created for " + root_file
 # pixel = pixelate_pair((lng, lat))
 
 # Generate pixel demand data
-# d, x_max = demand.pixel_demand_per_minute(trip_log, root_file, pixel, MINUTES_IN_DAY)
+# d, x_max = demand.pixel_demand_per_minute(root_file, pixel, MINUTES_IN_DAY)
 # print "Demand Schedule Created for " + root_file + " pixel " + str(pixel)
 # title = "Demand for NYC Yellow Cabs Picking Up in Pixel Surrounding Penn Station"
 
 # Generate superpixel demand data
 # degree = 1
-# d, x_max = demand.superpixel_demand_per_minute(trip_log, root_file, pixel, degree, MINUTES_IN_DAY)
+# d, x_max = demand.superpixel_demand_per_minute(root_file, pixel, degree, MINUTES_IN_DAY)
 # print "Demand Schedule Created for " + root_file + " pixel " + str(pixel) + " degree " + str(degree)
 # title = "Demand for NYC Yellow Cabs Picking Up in Superpixel (deg=1) Surrounding Penn Station"
 
 # Generate 2-degree superpixel demand data
 # degree = 2
-# d, x_max = demand.superpixel_demand_per_minute(trip_log, root_file, pixel, degree, MINUTES_IN_DAY)
+# d, x_max = demand.superpixel_demand_per_minute(root_file, pixel, degree, MINUTES_IN_DAY)
 # print "Demand Schedule Created for " + root_file + " pixel " + str(pixel) + " degree " + str(degree)
 # print d
 # title = "Demand for NYC Yellow Cabs Picking Up in Superpixel (deg=2) Surrounding Penn Station"
 
 # Generate 10-degree superpixel demand data
 # degree = 10
-# d, x_max = demand.superpixel_demand_per_minute(trip_log, root_file, pixel, degree, MINUTES_IN_DAY)
+# d, x_max = demand.superpixel_demand_per_minute(root_file, pixel, degree, MINUTES_IN_DAY)
 # print "Demand Schedule Created for " + root_file + " pixel " + str(pixel) + " degree " + str(degree)
 # title = "Demand for NYC Yellow Cabs Picking Up in Superpixel (deg=10) Surrounding Penn Station"
 
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+    File: sweep.py
+    Author: Keith Gladstone
+    Description:
+        Parameter sweeps for online.py and run_learning.py
+    Notes:
+        A sweep is one arg dict per configuration in the Cartesian product
+        of the parameter lists, indexed in the order of the nested loops it
+        replaces (departure delay outermost, LEVRS frequency innermost)
+        Experiments run longest first (fleet size x trips), so the big
+        fleets do not start last and finish far behind the rest, and each
+        one is handed out on its own as a worker frees up
+        Workers memory-map the trip store and the priors, the caller makes
+        sure both are converted before the sweep starts
+        Workers return their performance records and run_sweep appends
+        each one to the out file as it arrives, so only one process writes
+        A sweep resumes from its out file: configurations that already
+        have a row there, matching on every one of SWEEP_PARAMETERS, are
+        skipped
+"""
+import itertools
+from multiprocessing import Pool
+
+import performance
+import trip_store
+
+SWEEP_PARAMETERS = ('departure_delay',
+                    'fleet_size',
+                    'max_circuity',
+                    'vehicle_size',
+                    'max_stops',
+                    'local_demand_degree',
+                    'greedy_common_origin',
+                    'batch_rideshare',
+                    'initial_beta',
+                    'beta_obs',
+                    'freq_levrs')
+
+def make_sweep(raw_data_file_name, parameter_lists):
+    '''Arg dicts of every configuration, parameter_lists maps each of
+       SWEEP_PARAMETERS to its list of values'''
+    list_of_arg_dicts = list()
+    configurations = itertools.product(*[parameter_lists[parameter]
+                                         for parameter in SWEEP_PARAMETERS])
+    for index, values in enumerate(configurations):
+        arg_dict = dict(zip(SWEEP_PARAMETERS, values))
+        arg_dict['index'] = index
+        arg_dict['raw'] = raw_data_file_name
+        list_of_arg_dicts.append(arg_dict)
+    return list_of_arg_dicts
+
+def config_key(values):
+    '''Comparable key of SWEEP_PARAMETERS values, numbers, flags or strings of them'''
+    return tuple(float(value) for value in values)
+
+def completed_configs(filename):
+    '''Keys of the configurations that already have a row in the out file'''
+    completed = set()
+    for record in performance.read_results(filename):
+        completed.add(config_key([record[parameter] for parameter in SWEEP_PARAMETERS]))
+    return completed
+
+def pending_experiments(list_of_arg_dicts, filename):
+    '''Drop the experiments whose configuration is already in the out file'''
+    completed = completed_configs(filename)
+    return [arg_dict for arg_dict in list_of_arg_dicts
+            if config_key([arg_dict[parameter] for parameter in SWEEP_PARAMETERS])
+            not in completed]
+
+def estimated_cost(arg_dict, number_of_trips):
+    return arg_dict['fleet_size'] * number_of_trips
+
+def longest_first(list_of_arg_dicts, number_of_trips):
+    '''Order by estimated cost, most expensive first, ties in index order'''
+    return sorted(list_of_arg_dicts,
+                  key=lambda arg_dict: (-estimated_cost(arg_dict, number_of_trips),
+                                        arg_dict['index']))
+
+def run_sweep(run_experiment, list_of_arg_dicts, cleaned_filepath, filename, do_pool=True):
+    '''Run the experiments not yet in the out file, longest first.
+       run_experiment returns the experiment's performance record.'''
+    pending = pending_experiments(list_of_arg_dicts, filename)
+    skipped = len(list_of_arg_dicts) - len(pending)
+    if skipped > 0:
+        print "Resuming: %s experiments already in %s" % (skipped, filename)
+    number_of_trips = len(trip_store.TripStore(cleaned_filepath))
+    ordered = longest_first(pending, number_of_trips)
+
+    print "Running %s experiments..." % (len(ordered))
+
+    # Parallel
+    if do_pool:
+        print "In Parallel"
+        pool = Pool()
+        finished = 0
+        for record in pool.imap_unordered(run_experiment, ordered):
+            performance.write_results(filename, [record])
+            finished += 1
+            print "Done with Experiment #%s (%s of %s)" % (record['index'], finished, len(ordered))
+        pool.close()
+        pool.join()
+
+    # Series
+    else:
+        print "In Series"
+        for arg_dict in ordered:
+            performance.write_results(filename, [run_experiment(arg_dict)])
+    return
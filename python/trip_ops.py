@@ -5,36 +5,50 @@
 
     Description:
         All operations for a Trip object
+    Notes:
+        The legs of a joined (rideshared) trip are linked through
+        joined_trip_id, the last leg links to itself. A Route owns the
+        same legs as a list with their occupancy, person miles and vehicle
+        miles, and every leg points to it through trip.route, so the chain
+        is not walked again for each question about it
 """
 
 import csv
 import pixel_ops
+import trip_store
+
+# Set True to check every Trip as it is read and changed (off in production runs)
+VALIDATE = False
+
+# Column order of the results CSVs, which is the order the fields used to come
+# out of a Trip's __dict__
+TRIP_FIELDS = ('vehicle_id', 'original_dropoff_time', 'pickup_time', 'pickup_request_time',
+               'occupancy', 'dropoff_pixel', 'day_of_week', 'joined_trip_id', 'trip_id',
+               'pickup_pixel', 'dropoff_time')
 
 ''' Trip Object '''
 class Trip(object):
+    '''Pixels are (x, y) int tuples, parse strings with parse_pair_with_paren first'''
+    __slots__ = TRIP_FIELDS + ('route',)
+
     def __init__(self, trip_id, pickup_pixel, dropoff_pixel,
                  pickup_request_time, original_dropoff_time, pickup_time,
                  dropoff_time, occupancy, day_of_week):
         self.trip_id = trip_id
         self.joined_trip_id = trip_id
         self.vehicle_id = trip_id
-        if isinstance(pickup_pixel, str):
-            x, y = pickup_pixel.replace("(", "").replace(")", "").replace(" ", "").split(",")
-            self.pickup_pixel = int(x), int(y)
-        else:
-            self.pickup_pixel = pickup_pixel
-        if isinstance(dropoff_pixel, str):
-            x, y = dropoff_pixel.replace("(", "").replace(")", "").replace(" ", "").split(",")
-            self.dropoff_pixel = int(x), int(y)
-        else:
-            self.dropoff_pixel = dropoff_pixel
+        self.pickup_pixel = pickup_pixel
+        self.dropoff_pixel = dropoff_pixel
         self.pickup_request_time = pickup_request_time
         self.original_dropoff_time = original_dropoff_time
         self.pickup_time = pickup_time
         self.dropoff_time = dropoff_time
         self.occupancy = occupancy
         self.day_of_week = day_of_week
-        assert(not isinstance(self.pickup_pixel, str)), pickup_pixel
+        self.route = None
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in TRIP_FIELDS)
 
     def valid(self):
         if self.original_dropoff_time < self.pickup_request_time:
@@ -43,21 +57,21 @@ class Trip(object):
             Error: Trip Invalid
             original dropoff < pickup request
             Trip is %s
-            """ % (self.__dict__)
+            """ % (self.to_dict())
         if self.pickup_time < self.pickup_request_time:
             assert False, \
             """
             Error: Trip Invalid
             pickup < pickup request
             Trip is %s
-            """ % (self.__dict__)
+            """ % (self.to_dict())
         if self.occupancy == 0:
             assert False, \
             """
             Error: Trip Invalid
             occupancy 0
             Trip is %s
-            """ % (self.__dict__)
+            """ % (self.to_dict())
 
         return True
 
@@ -79,13 +93,13 @@ class Trip(object):
     def increase_time_delay(self, time_delay):
         self.pickup_time += time_delay
         self.dropoff_time += time_delay
-        assert(self.valid()), "Increase Time Delay Broke It"
+        assert(not VALIDATE or self.valid()), "Increase Time Delay Broke It"
         return self
 
     def set_actual_t(self, pickup_time, dropoff_time):
         self.pickup_time = pickup_time
         self.dropoff_time = dropoff_time
-        assert(self.valid()), "Set Actual Time Broke It"
+        assert(not VALIDATE or self.valid()), "Set Actual Time Broke It"
         return self
 
     def get_time_delay(self):
@@ -93,7 +107,7 @@ class Trip(object):
 
     def set_vehicle(self, vehicle_id):
         self.vehicle_id = vehicle_id
-        assert(self.valid()), "Set Vehicle ID Broke It"
+        assert(not VALIDATE or self.valid()), "Set Vehicle ID Broke It"
         return self
 
     def same_pickup_info(self, that):
@@ -141,14 +155,54 @@ def is_same_trip(t1, t2):
 def get_trip(trip_log, trip_id):
     return trip_log[int(trip_id)]
 
-def get_last_joined_trip(trip_log, primary_trip_id):
-    trip = get_trip(trip_log, primary_trip_id)
-    while trip.trip_id != trip.joined_trip_id:
-        trip = get_trip(trip_log, trip.joined_trip_id)
-    return trip
+class Route(object):
+    '''Legs of a joined trip in dropoff order, with their aggregates'''
+    __slots__ = ('legs', 'occupancy', 'person_miles', 'vehicle_miles')
+
+    def __init__(self, legs):
+        self.legs = list()
+        self.occupancy = 0
+        self.person_miles = 0
+        self.vehicle_miles = 0
+        self.resequence(legs)
+
+    @property
+    def first(self):
+        return self.legs[0]
+
+    @property
+    def last(self):
+        return self.legs[-1]
+
+    def resequence(self, legs):
+        '''Take legs, the current legs plus any new ones, in their new dropoff order.
+           Occupancy and person miles only change by the new legs, vehicle miles
+           depend on the order.'''
+        current = set(id(leg) for leg in self.legs)
+        for leg in legs:
+            if id(leg) not in current:
+                self.occupancy += leg.occupancy
+                self.person_miles += \
+                    leg.occupancy * pixel_ops.manhattan_distance(leg.pickup_pixel, leg.dropoff_pixel)
+        self.legs = list(legs)
+        self.vehicle_miles = 0
+        leg_start = self.legs[0].pickup_pixel
+        for leg in self.legs:
+            self.vehicle_miles += pixel_ops.manhattan_distance(leg_start, leg.dropoff_pixel)
+            leg_start = leg.dropoff_pixel
+        return self
 
+    def attach(self):
+        '''Link the legs' joined_trip_ids in order and point them to this route'''
+        for leg, next_leg in zip(self.legs, self.legs[1:]):
+            leg.joined_trip_id = next_leg.trip_id
+            leg.route = self
+        self.last.joined_trip_id = self.last.trip_id
+        self.last.route = self
+        return self
 
-def get_all_joined_trips(trip_log, primary_trip_id):
+def walk_joined_trips(trip_log, primary_trip_id):
+    '''Follow the joined_trip_id links from a trip to the last leg'''
     trip = get_trip(trip_log, primary_trip_id)
     l = [trip]
     while trip.trip_id != trip.joined_trip_id:
@@ -156,41 +210,53 @@ def get_all_joined_trips(trip_log, primary_trip_id):
         l.append(trip)
     return l
 
+def get_route(trip_log, primary_trip_id):
+    '''Route of the legs from a trip on. Cached when the trip is a route's first
+       leg, trips without a route (read from a file) get one.'''
+    trip = get_trip(trip_log, primary_trip_id)
+    if trip.route is not None and trip.route.first is trip:
+        return trip.route
+    route = Route(walk_joined_trips(trip_log, primary_trip_id))
+    if trip.route is None:
+        route.attach()
+    return route
+
+def get_last_joined_trip(trip_log, primary_trip_id):
+    return get_route(trip_log, primary_trip_id).last
+
+def get_all_joined_trips(trip_log, primary_trip_id):
+    return list(get_route(trip_log, primary_trip_id).legs)
+
 def get_person_miles_of_joined_trip(trip_log, primary_trip_id):
-    PM = 0
-    legs = get_all_joined_trips(trip_log, primary_trip_id)
-    for leg in legs:
-        direct_occupancy = leg.occupancy
-        direct_distance = pixel_ops.manhattan_distance(leg.pickup_pixel, leg.dropoff_pixel)
-        PM += direct_occupancy * direct_distance
-    return PM
+    return get_route(trip_log, primary_trip_id).person_miles
 
 def get_vehicle_miles_of_joined_trip(trip_log, primary_trip_id):
-    VM = 0
-    legs = get_all_joined_trips(trip_log, primary_trip_id)
-    leg_start = legs[0].pickup_pixel
-    for leg in legs:
-        VM += pixel_ops.manhattan_distance(leg_start, leg.dropoff_pixel)
-        leg_start = leg.dropoff_pixel
-    return VM
+    return get_route(trip_log, primary_trip_id).vehicle_miles
 
 
-def get_weighted_circuity_of_trip(trip_log, primary_trip_id):
-    legs = get_all_joined_trips(trip_log, primary_trip_id)
-    weighted_circuity = 0.0
-    circuitous_distance = 0.0
+def get_leg_circuities(legs):
+    '''(leg, circuity) of the legs of a joined trip, in dropoff order.
+       A leg's circuity is the distance its occupants ride, from the first
+       pickup through the earlier dropoffs, over its direct distance.
+       Zero distance legs have no circuity and are left out.'''
+    circuities = list()
+    circuitous_distance = 0
     leg_start = legs[0].pickup_pixel
-    total_occupancy = sum([leg.occupancy for leg in legs])
-    assert(total_occupancy != 0), "Total Occupancy is 0" + str(legs[0])
     for leg in legs:
-        direct_distance = pixel_ops.manhattan_distance(leg.pickup_pixel, leg.dropoff_pixel)
-        assert(direct_distance != 0), "Trip is Zero Distance"
         circuitous_distance += pixel_ops.manhattan_distance(leg_start, leg.dropoff_pixel)
-        weighted_circuity += (1.0 * (leg.occupancy * circuitous_distance) /
-                              direct_distance) / total_occupancy
         leg_start = leg.dropoff_pixel
+        direct_distance = pixel_ops.manhattan_distance(leg.pickup_pixel, leg.dropoff_pixel)
+        if direct_distance != 0:
+            circuities.append((leg, 1.0 * circuitous_distance / direct_distance))
+    return circuities
 
-    return weighted_circuity
+def get_weighted_circuity_of_trip(trip_log, primary_trip_id):
+    '''Per occupant circuity of a joined trip, 1 if no leg has a circuity'''
+    circuities = get_leg_circuities(get_all_joined_trips(trip_log, primary_trip_id))
+    total_occupancy = sum(leg.occupancy for leg, _ in circuities)
+    if total_occupancy == 0:
+        return 1.0
+    return sum(leg.occupancy * circuity for leg, circuity in circuities) / total_occupancy
 
 def is_trip_in_progress(trip_log, trip_id, time):
     trip = get_trip(trip_log, trip_id)
@@ -217,26 +283,23 @@ def process_cleaned_trip(t):
         int(t['day_of_week'])
         )
 
-def read_n_cleaned_trips(reader, n):
+def read_n_cleaned_trips(trips, n):
+    '''Read the first n trips of a Trip iterator, also consuming trip n + 1'''
     trip_log = dict()
     k = 0
-    for t in reader:
+    for trip in trips:
         if k == n:
             break
-        trip = process_cleaned_trip(t)
-        assert(trip.valid()), "Read n Cleaned Trips"
+        assert(not VALIDATE or trip.valid()), "Read n Cleaned Trips"
         trip_log[trip.trip_id] = trip
         k += 1
     return trip_log
 
 def read_cleaned_trips(csv_fp):
     trip_log = dict()
-    with open(csv_fp, 'rb') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for t in reader:
-            trip = process_cleaned_trip(t)
-            assert(trip.valid()), "Read Cleaned Trips"
-            trip_log[trip.trip_id] = trip
+    for trip in trip_store.TripStore(csv_fp):
+        assert(not VALIDATE or trip.valid()), "Read Cleaned Trips"
+        trip_log[trip.trip_id] = trip
     return trip_log
 
 def read_cleaned_vehicles(csv_fp):
@@ -248,8 +311,12 @@ def read_cleaned_vehicles(csv_fp):
             vehicles_log[vehicle.vehicle_id] = vehicle
     return vehicles_log
 
+def trip_log_fp(root_file):
+    '''Get the cleaned trips file that get_trip_log reads'''
+    return '../csv/cleaned/' + root_file + '_cleaned.csv'
+
 def get_trip_log(root_file):
-    csv_fp = '../csv/cleaned/' + root_file + '_cleaned.csv'
+    csv_fp = trip_log_fp(root_file)
     trip_log = read_cleaned_trips(csv_fp) # Trip Schedule
     return trip_log
 
@@ -265,8 +332,8 @@ def read_result_trips(csv_fp):
         for t in reader:
             trip = Trip(
                 int(t['trip_id']),
-                t['pickup_pixel'],
-                t['dropoff_pixel'],
+                parse_pair_with_paren(t['pickup_pixel']),
+                parse_pair_with_paren(t['dropoff_pixel']),
                 int(float(t['pickup_request_time'])),
                 int(float(t['original_dropoff_time'])),
                 int(float(t['pickup_time'])),
@@ -274,7 +341,7 @@ def read_result_trips(csv_fp):
                 int(t['occupancy']),
                 int(t['day_of_week'])
                 )
-            assert(trip.valid()), "Read Result Trips"
+            assert(not VALIDATE or trip.valid()), "Read Result Trips"
             trip_log[trip.trip_id] = trip
     return trip_log
 
@@ -284,21 +351,20 @@ def get_results_trip_log(csv_fp):
 
 def write_trip_log(table_dict, raw, index):
     table = table_dict.values()
-    keys = table[0].__dict__.keys()
     with open('../csv/results/' + raw + "_" + str(index) + "_results.csv", 'wb') as f:
-        dict_writer = csv.DictWriter(f, keys)
+        dict_writer = csv.DictWriter(f, TRIP_FIELDS)
         dict_writer.writeheader()
         for row in table:
-            dict_writer.writerow(row.__dict__)
+            dict_writer.writerow(row.to_dict())
 
 def write_vehicles_log(table_dict, raw, index):
     table = table_dict.values()
-    keys = table[0].__dict__.keys()
+    keys = table[0].to_dict().keys()
     with open('../csv/results/' + raw + "_" + index + "_results_vehicles.csv", 'wb') as f:
         dict_writer = csv.DictWriter(f, keys)
         dict_writer.writeheader()
         for row in table:
-            dict_writer.writerow(row.__dict__)
+            dict_writer.writerow(row.to_dict())
 
 def write_dict_to_csv(t, fn, header):
     with open('../csv/' + fn, 'wb') as csv_file:
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+    File: trip_store.py
+    Author: Keith Gladstone
+
+    Description:
+        Columnar binary copy of a cleaned trip schedule, so simulations
+        and learning runs stop re-parsing the cleaned CSV.
+    Notes:
+        One typed .npy file per column, <prefix>_<column>.npy, where the
+        prefix is the cleaned CSV path without ".csv".
+        The columns are converted from the CSV once and converted again
+        only when the CSV is newer. They are loaded memory-mapped, so
+        experiments running side by side share the same pages.
+        Trips come out in file order, the order csv.DictReader gave.
+"""
+import os
+
+import numpy as np
+
+import trip_ops
+
+COLUMNS = (('trip_id', np.int64),
+           ('oX', np.int32),
+           ('oY', np.int32),
+           ('dX', np.int32),
+           ('dY', np.int32),
+           ('pickup_request_time', np.int64),
+           ('original_dropoff_time', np.int64),
+           ('occupancy', np.int32),
+           ('day_of_week', np.int32))
+
+TRIPS_PER_CHUNK = 4096
+
+def store_prefix(csv_fp):
+    '''Prefix of the column files that belong to a cleaned CSV'''
+    return os.path.splitext(csv_fp)[0]
+
+def column_fp(prefix, column):
+    return prefix + "_" + column + ".npy"
+
+def is_converted(csv_fp):
+    '''Are the column files there and at least as new as the CSV?'''
+    # trip_id is written last, so it only exists once the others are complete
+    trip_id_fp = column_fp(store_prefix(csv_fp), 'trip_id')
+    return os.path.isfile(trip_id_fp) and \
+           os.path.getmtime(trip_id_fp) >= os.path.getmtime(csv_fp)
+
+def convert_cleaned_trips(csv_fp):
+    '''Parse a cleaned CSV into the column files, if not done yet'''
+    if is_converted(csv_fp):
+        return
+    print "Converting cleaned trips to binary columns"
+    with open(csv_fp, 'rb') as csv_file:
+        header = csv_file.readline().strip().split(",")
+        usecols = [header.index(column) for column, _ in COLUMNS]
+        # Same truncation as int(float(...)) in trip_ops.process_cleaned_trip
+        rows = np.loadtxt(csv_file, delimiter=",", usecols=usecols, ndmin=2)
+    prefix = store_prefix(csv_fp)
+    for index, (column, dtype) in reversed(list(enumerate(COLUMNS))):
+        np.save(column_fp(prefix, column), rows[:, index].astype(dtype))
+    print "Done converting trips"
+
+class TripStore(object):
+    '''Memory-mapped trip columns of one cleaned CSV'''
+    def __init__(self, csv_fp, mmap_mode="r"):
+        convert_cleaned_trips(csv_fp)
+        prefix = store_prefix(csv_fp)
+        self.columns = dict((column, np.load(column_fp(prefix, column), mmap_mode=mmap_mode))
+                            for column, _ in COLUMNS)
+
+    def __len__(self):
+        return len(self.columns['trip_id'])
+
+    def __iter__(self):
+        for start in xrange(0, len(self), TRIPS_PER_CHUNK):
+            for trip in self.trips(start, start + TRIPS_PER_CHUNK):
+                yield trip
+
+    def trips(self, start, stop):
+        '''Build the Trips of rows start to stop'''
+        rows = zip(*[self.columns[column][start:stop].tolist() for column, _ in COLUMNS])
+        return [trip_ops.Trip(trip_id, (o_x, o_y), (d_x, d_y),
+                              pickup_request_time, original_dropoff_time,
+                              pickup_request_time, original_dropoff_time,
+                              occupancy, day_of_week)
+                for trip_id, o_x, o_y, d_x, d_y, pickup_request_time,
+                    original_dropoff_time, occupancy, day_of_week in rows]
+
+    def stream(self):
+        return TripStream(self)
+
+class TripStream(object):
+    '''Hands out a TripStore's trips in file order.
+       Iterate it like a reader, or pull all requests up to a time with receive.'''
+    def __init__(self, trip_store):
+        self.trip_store = trip_store
+        self.request_times = trip_store.columns['pickup_request_time']
+        self.position = 0      # next trip to hand out
+        self.holding = False   # the trip at position was read past and is held over
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.position >= len(self.trip_store):
+            raise StopIteration
+        self.holding = False
+        trip = self.trip_store.trips(self.position, self.position + 1)[0]
+        self.position += 1
+        return trip
+
+    def receive(self, time):
+        '''Listen for requests at this time.
+           Returns the held over trip (if any) plus every following trip requested
+           by time, and holds over the first trip requested after it.
+           Returns None once the store runs out; requests still pending are dropped.'''
+        start = self.position
+        scan = start + 1 if self.holding else start
+        chunk = 256
+        while True:
+            window = self.request_times[scan:scan + chunk]
+            if len(window) == 0:
+                self.position, self.holding = len(self.trip_store), False
+                return None
+            later = np.flatnonzero(window > time)
+            if len(later) > 0:
+                stop = scan + int(later[0])
+                break
+            scan += len(window)
+            chunk *= 2
+        self.position, self.holding = stop, True
+        return self.trip_store.trips(start, stop)
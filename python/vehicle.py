@@ -5,25 +5,48 @@
 
     Description:
         All operations for a Vehicle object
+    Notes:
+        The fleet is stored column by column in a FleetState, one NumPy
+        array per field indexed by vehicle_id. A Vehicle is a thin view of
+        one row, so the handler can still work with one vehicle at a time
+        while fleet-wide scans and sums run over whole columns.
 """
+import numpy as np
+
 import pixel_ops
+
+def column_property(column):
+    '''Read and write one vehicle's entry of a FleetState column'''
+    def get_field(self):
+        return getattr(self.fleet, column)[self.vehicle_id].item()
+    def set_field(self, value):
+        getattr(self.fleet, column)[self.vehicle_id] = value
+    return property(get_field, set_field)
+
 class Vehicle(object):
-    '''A vehicle will be registered in the Vehicle Log dictionary'''
-    '''Construct vehicle with initial trip scheduled'''
-    def __init__(self, vehicle_id,
-                 latest_trip,
-                 cumulative_reposition_distance,
-                 most_recently_pinged_location,
-                 time_of_last_ping,
-                 cumulative_person_miles,
-                 cumulative_vehicle_miles):
-        self.latest_trip = latest_trip
+    '''A vehicle will be registered in the Vehicle Log, a FleetState'''
+    __slots__ = ('fleet', 'vehicle_id')
+
+    def __init__(self, fleet, vehicle_id):
+        self.fleet = fleet
         self.vehicle_id = vehicle_id
-        self.most_recently_pinged_location = most_recently_pinged_location
-        self.time_of_last_ping = time_of_last_ping
-        self.cumulative_reposition_distance = cumulative_reposition_distance
-        self.cumulative_person_miles = cumulative_person_miles
-        self.cumulative_vehicle_miles = cumulative_vehicle_miles
+
+    latest_trip = column_property('latest_trip')
+    time_of_last_ping = column_property('time_of_last_ping')
+    cumulative_reposition_distance = column_property('cumulative_reposition_distance')
+    cumulative_person_miles = column_property('cumulative_person_miles')
+    cumulative_vehicle_miles = column_property('cumulative_vehicle_miles')
+
+    @property
+    def most_recently_pinged_location(self):
+        return (self.fleet.x[self.vehicle_id].item(), self.fleet.y[self.vehicle_id].item())
+
+    @most_recently_pinged_location.setter
+    def most_recently_pinged_location(self, location):
+        self.fleet.x[self.vehicle_id], self.fleet.y[self.vehicle_id] = location
+
+    def update_index(self):
+        self.fleet.update_index(self.vehicle_id)
 
     def add_trip_to_schedule(self, trip):
         self.latest_trip = trip.trip_id
@@ -32,28 +55,28 @@ class Vehicle(object):
                                                                  trip.pickup_pixel))
         self.cumulative_reposition_distance += reposition_distance
         self.most_recently_pinged_location = trip.dropoff_pixel
+        self.update_index()
         return self
 
     # Current policy does not allow vehicle to be interrupted while repositioning
     # Perhaps we only let it move one pixel per time iteration
     def empty_reposition(self, reposition_start_time, reposition_location):
-        reposition_distance = float(pixel_ops.manhattan_distance(self.most_recently_pinged_location,
-                                                                 reposition_location))
-        self.cumulative_reposition_distance += reposition_distance
-        reposition_duration = pixel_ops.time_of_travel(self.most_recently_pinged_location,
-                                                       reposition_location)
-        self.most_recently_pinged_location = reposition_location
-        self.time_of_last_ping = reposition_start_time + reposition_duration
+        target_x, target_y = reposition_location
+        self.fleet.empty_reposition([self.vehicle_id], [target_x], [target_y],
+                                    reposition_start_time)
         return self
 
-
     def replace_last_trip(self, new_trip):
         self.latest_trip = new_trip.trip_id
         self.most_recently_pinged_location = new_trip.dropoff_pixel
         self.time_of_last_ping = new_trip.dropoff_time
+        self.update_index()
         return self
 
     def __repr__(self):
+        return str(self.to_dict())
+
+    def to_dict(self):
         my_dict = dict()
         my_dict['latest_trip'] = self.latest_trip
         my_dict['vehicle_id'] = self.vehicle_id
@@ -62,4 +85,77 @@ class Vehicle(object):
         my_dict['cumulative_reposition_distance'] = self.cumulative_reposition_distance
         my_dict['cumulative_person_miles'] = self.cumulative_person_miles
         my_dict['cumulative_vehicle_miles'] = self.cumulative_vehicle_miles
-        return str(my_dict)
+        return my_dict
+
+class FleetState(object):
+    '''Struct-of-arrays store for the whole fleet, indexed by vehicle_id 0..n-1.
+       Reads like the old dict of vehicles: iterating gives vehicle ids
+       and indexing gives a Vehicle view.'''
+    def __init__(self, fleet_size):
+        self.x = np.zeros(fleet_size, dtype=int)
+        self.y = np.zeros(fleet_size, dtype=int)
+        self.time_of_last_ping = np.zeros(fleet_size)
+        self.latest_trip = np.full(fleet_size, -1, dtype=int)
+        self.cumulative_reposition_distance = np.zeros(fleet_size)
+        self.cumulative_person_miles = np.zeros(fleet_size)
+        self.cumulative_vehicle_miles = np.zeros(fleet_size)
+        self.views = [Vehicle(self, vehicle_id) for vehicle_id in xrange(fleet_size)]
+        self.fleet_index = None
+
+    def __len__(self):
+        return len(self.views)
+
+    def __iter__(self):
+        return iter(xrange(len(self.views)))
+
+    def __contains__(self, vehicle_id):
+        return 0 <= vehicle_id < len(self.views)
+
+    def __getitem__(self, vehicle_id):
+        return self.views[vehicle_id]
+
+    def keys(self):
+        return range(len(self.views))
+
+    def values(self):
+        return list(self.views)
+
+    def items(self):
+        return list(enumerate(self.views))
+
+    def register(self, fleet_index):
+        '''Link the fleet to a FleetIndex, which is kept in sync from now on'''
+        self.fleet_index = fleet_index
+        for vehicle_id in self:
+            self.update_index(vehicle_id)
+        return self
+
+    def update_index(self, vehicle_id):
+        if self.fleet_index is not None:
+            self.fleet_index.update(vehicle_id,
+                                    (self.x[vehicle_id].item(), self.y[vehicle_id].item()),
+                                    self.time_of_last_ping[vehicle_id].item())
+
+    def idle_vehicle_ids(self, time):
+        '''Ids of vehicles whose last ping is before time'''
+        return np.flatnonzero(self.time_of_last_ping < time)
+
+    def idle_count(self, time):
+        '''Number of vehicles whose last ping is before time'''
+        return int(np.count_nonzero(self.time_of_last_ping < time))
+
+    def empty_reposition(self, vehicle_ids, target_x, target_y, reposition_start_time):
+        '''Move many empty vehicles at once, vehicle_ids must be distinct'''
+        vehicle_ids = np.asarray(vehicle_ids, dtype=int)
+        target_x = np.asarray(target_x, dtype=int)
+        target_y = np.asarray(target_y, dtype=int)
+        reposition_distance = (np.abs(target_x - self.x[vehicle_ids]) +
+                               np.abs(target_y - self.y[vehicle_ids])).astype(float)
+        self.cumulative_reposition_distance[vehicle_ids] += reposition_distance
+        self.x[vehicle_ids] = target_x
+        self.y[vehicle_ids] = target_y
+        self.time_of_last_ping[vehicle_ids] = \
+            reposition_start_time + reposition_distance / pixel_ops.MANHATTAN_SPEED
+        for vehicle_id in vehicle_ids.tolist():
+            self.update_index(vehicle_id)
+        return self